@@ -0,0 +1,75 @@
+"""
+Bytes retained per pending booking by bike payloads: full bikes.json dicts
+kept in every waiting greenlet before, compact Bike records shared by the
+area snapshots now.
+
+    python -m benchmarks.bike_memory [bookings_per_area]
+"""
+import json
+import sys
+import tracemalloc
+from booker.bikes import parse_bikes
+from booker.scheduler import Search
+from booker.scoring import DEFAULT_CRITERIA
+
+
+def bike_payload(count, offset=0):
+    """ A bikes.json page shaped like the Social Bicycles one. """
+
+    return json.dumps({
+        'current_page': 1,
+        'per_page': count,
+        'total_entries': count,
+        'items': [
+            {
+                'id': offset + i,
+                'name': f'{offset + i:04d}',
+                'network_id': 48,
+                'sponsored': False,
+                'ebike_battery_level': 30 + i % 70,
+                'ebike_battery_distance': 40.5,
+                'hub_id': None,
+                'inside_area': True,
+                'address': f'{100 + i} Market Street, San Francisco, CA',
+                'distance': 120.5 + i,
+                'current_position': {
+                    'type': 'Point',
+                    'coordinates': [-122.4 + i * 1e-4, 37.77 + i * 1e-4],
+                },
+                'repair_state': 'working',
+                'bonuses': [],
+            }
+            for i in range(count)
+        ],
+    })
+
+
+def retained(build):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return kept, after - before
+
+
+def main(bookings_per_area=5):
+    # Before: every waiting booking holds its own page of 10 raw dicts.
+    _, raw = retained(lambda: json.loads(bike_payload(10))['items'])
+
+    # Now: one page of 50 Bike records per area, plus a Search per booking.
+    _, snapshot = retained(lambda: parse_bikes(bike_payload(50)))
+    _, search = retained(lambda: Search(
+        1, 37.77, -122.4, DEFAULT_CRITERIA, 300.0, None))
+    compact = snapshot / bookings_per_area + search
+
+    print(f'raw dicts, 10 per booking:        {raw:8d} bytes/booking')
+    print(f'Bike records, 50 per area:        {snapshot:8d} bytes/area')
+    print(f'Search record:                    {search:8d} bytes/booking')
+    print(
+        f'now, {bookings_per_area} bookings per area:         '
+        f'{compact:8.0f} bytes/booking')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
@@ -0,0 +1,86 @@
+"""
+Time deep pages of the booking history with OFFSET pagination against
+keyset pagination, over a seeded bookings table.
+
+Seeds into DATABASE_URL, so point it at a scratch database:
+
+    DATABASE_URL=sqlite:////tmp/bench.db \\
+        python -m benchmarks.bookings_pagination [rows]
+"""
+from datetime import datetime, timedelta
+import random
+import sys
+import time
+from booker import create_app, db
+from booker.models import Users, Bookings
+from booker.pagination import keyset_paginate, encode_cursor
+
+PER_PAGE = 10
+SEED_CHUNK = 50000
+
+
+def seed(rows):
+    db.drop_all()
+    db.create_all()
+    users = [
+        Users(
+            username=f'user{i}', email=f'user{i}@example.com',
+            password='x')
+        for i in range(10)
+    ]
+    db.session.add_all(users)
+    db.session.commit()
+
+    # One power user owns half of the history.
+    power_user = users[0]
+    start = datetime.utcnow() - timedelta(days=3 * 365)
+    for offset in range(0, rows, SEED_CHUNK):
+        db.session.execute(Bookings.__table__.insert(), [
+            {
+                'requester_id': (
+                    power_user.id if i % 2 else random.choice(users).id),
+                'query': 'home',
+                'status': 'booked',
+                'auto_book': True,
+                'is_deleted': False,
+                'created_at': start + timedelta(seconds=90 * i),
+                'updated_at': start + timedelta(seconds=90 * i),
+            }
+            for i in range(offset, min(offset + SEED_CHUNK, rows))
+        ])
+        db.session.commit()
+    return power_user
+
+
+def timed(function):
+    started = time.perf_counter()
+    result = function()
+    return result, (time.perf_counter() - started) * 1000
+
+
+def main(rows=1000000):
+    with create_app().app_context():
+        user, seconds = timed(lambda: seed(rows))
+        print(f'seeded {rows} rows in {seconds / 1000:.1f}s')
+        history = db.session.query(Bookings).filter_by(
+            requester_id=user.id, is_deleted=False)
+        total = history.count()
+        last_page = total // PER_PAGE
+
+        print(f'{"page":>8} {"offset (ms)":>12} {"keyset (ms)":>12}')
+        ordered = history.order_by(
+            Bookings.created_at.desc(), Bookings.id.desc())
+        for page in sorted({1, 10, 100, 1000, last_page // 2, last_page}):
+            # The cursor a reader would hold when reaching this page.
+            cursor = encode_cursor(
+                ordered.offset((page - 1) * PER_PAGE - 1).first()
+            ) if page > 1 else None
+            _, offset_ms = timed(lambda: ordered.paginate(
+                page=page, per_page=PER_PAGE))
+            _, keyset_ms = timed(lambda: keyset_paginate(
+                history, Bookings, cursor, PER_PAGE))
+            print(f'{page:>8} {offset_ms:>12.2f} {keyset_ms:>12.2f}')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
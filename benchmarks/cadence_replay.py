@@ -0,0 +1,175 @@
+"""
+Replay bikes.json snapshots against the fixed and the adaptive poll cadence,
+comparing the share of bookings matched with the API calls spent.
+
+    python -m benchmarks.cadence_replay [recording.jsonl] [bookings]
+
+A recording has one snapshot per line, {"at": seconds, "latitude": ...,
+"longitude": ..., "bikes": <bikes.json payload>}. Without one, a synthetic
+city is generated with a busy downtown, a quieter district and a dead zone.
+"""
+import heapq
+import json
+import random
+import sys
+from bisect import bisect_right
+from collections import Counter, defaultdict
+from booker.bikes import Bike, parse_bikes
+from booker.cadence import AdaptiveCadence
+from booker.fleet import area_key, area_center
+from booker.spatial import distance_between
+
+RETRY_DELAY = 30
+SEARCH_WINDOW = 10 * RETRY_DELAY
+MAX_DISTANCE = 400
+MIN_BATTERY = 25
+HORIZON = 3600
+# Calls per second of a single Social Bicycles token, see TokenPool.
+TOKEN_RATE = 1
+
+
+def load_recording(path):
+    """ Snapshots by area, as sorted (times, bike lists). """
+
+    by_area = defaultdict(list)
+    with open(path) as recording:
+        for line in recording:
+            record = json.loads(line)
+            by_area[area_key(record['latitude'], record['longitude'])].append(
+                (record['at'], parse_bikes(json.dumps(record['bikes']))))
+    return {
+        area: ([at for at, _ in sorted(shots)],
+               [bikes for _, bikes in sorted(shots)])
+        for area, shots in by_area.items()
+    }
+
+
+def synthetic_city(seed=0):
+    """
+    One snapshot per second and area. Bikes show up at a rate and stay
+    parked for a while: often and briefly downtown, rarely in the dead zone.
+    """
+
+    rng = random.Random(seed)
+    profiles = {
+        (9447, -30597): (1 / 20, 40),
+        (9450, -30600): (1 / 90, 240),
+        (9460, -30610): (1 / 900, 900),
+    }
+    snapshots = {}
+    next_id = 1
+    for area, (rate, stay) in profiles.items():
+        latitude, longitude = area_center(area)
+        parked = []
+        times, shots = [], []
+        for second in range(HORIZON):
+            parked = [bike for bike in parked if bike[0] > second]
+            if rng.random() < rate:
+                parked.append((second + rng.expovariate(1 / stay), Bike(
+                    next_id, f'b{next_id}', '', rng.randint(10, 100),
+                    latitude + rng.uniform(-0.002, 0.002),
+                    longitude + rng.uniform(-0.002, 0.002))))
+                next_id += 1
+            times.append(second)
+            shots.append([bike for _, bike in parked])
+        snapshots[area] = (times, shots)
+    return snapshots
+
+
+def snapshot_at(snapshots, area, now):
+    times, shots = snapshots.get(area, ([], []))
+    position = bisect_right(times, now) - 1
+    return shots[position] if position >= 0 else []
+
+
+def replay(snapshots, bookings, cadence):
+    """ Run the bookings, polling each area at the cadence intervals. """
+
+    calls = 0
+    cache = {}
+    pending = Counter()
+    taken = set()
+    matched = []
+    heap = []
+    for booking_id, (at, latitude, longitude) in enumerate(bookings):
+        area = area_key(latitude, longitude)
+        heapq.heappush(heap, (at, booking_id, at, latitude, longitude, area))
+        pending[area] += 1
+
+    while heap:
+        now, booking_id, created, latitude, longitude, area = (
+            heapq.heappop(heap))
+        polled_at, bikes = cache.get(area, (None, None))
+        if polled_at is None or now - polled_at >= cadence.interval(area):
+            fresh = snapshot_at(snapshots, area, now)
+            calls += 1
+            if bikes is not None:
+                cadence.observe(
+                    area, {bike.id for bike in bikes},
+                    {bike.id for bike in fresh})
+            polled_at, bikes = now, fresh
+            cache[area] = polled_at, bikes
+
+        bike = next((
+            bike for bike in bikes
+            if bike.id not in taken and
+            bike.ebike_battery_level >= MIN_BATTERY and
+            distance_between(
+                latitude, longitude, bike.latitude, bike.longitude
+            ) <= MAX_DISTANCE
+        ), None)
+        # A bike gone by now was only in a stale snapshot, booking it fails.
+        if bike is not None and bike.id in {
+            parked.id for parked in snapshot_at(snapshots, area, now)
+        }:
+            taken.add(bike.id)
+            matched.append(now - created)
+        else:
+            due = now + cadence.interval(area)
+            if due <= created + SEARCH_WINDOW:
+                heapq.heappush(
+                    heap, (due, booking_id, created, latitude, longitude,
+                           area))
+                continue
+        pending[area] -= 1
+        if not pending[area]:
+            del pending[area]
+            cache.pop(area, None)
+            cadence.forget(area)
+    return calls, matched
+
+
+def main(path=None, count=300):
+    snapshots = load_recording(path) if path else synthetic_city()
+    rng = random.Random(1)
+    start = min(times[0] for times, _ in snapshots.values() if times)
+    end = max(times[-1] for times, _ in snapshots.values() if times)
+    areas = list(snapshots)
+    bookings = []
+    for _ in range(int(count)):
+        latitude, longitude = area_center(rng.choice(areas))
+        bookings.append((
+            rng.uniform(start, max(start, end - SEARCH_WINDOW)),
+            latitude + rng.uniform(-0.001, 0.001),
+            longitude + rng.uniform(-0.001, 0.001)))
+
+    policies = {
+        'fixed': AdaptiveCadence(
+            RETRY_DELAY, RETRY_DELAY, RETRY_DELAY, budget=lambda: TOKEN_RATE),
+        'adaptive': AdaptiveCadence(
+            RETRY_DELAY, RETRY_DELAY / 6, 2 * RETRY_DELAY,
+            budget=lambda: TOKEN_RATE),
+    }
+    print(f'{len(bookings)} bookings over {len(areas)} areas')
+    for name, cadence in policies.items():
+        calls, matched = replay(snapshots, bookings, cadence)
+        mean = sum(matched) / len(matched) if matched else 0
+        print(
+            f'{name:9s} matched {len(matched) / len(bookings):6.1%}  '
+            f'calls {calls:6d}  '
+            f'matches per 100 calls {100 * len(matched) / calls:6.1f}  '
+            f'mean time to match {mean:6.1f}s')
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
@@ -0,0 +1,83 @@
+"""
+Fail when the startup of a web worker regresses: building the app with
+python -X importtime must stay under a time budget, best of a few runs, and
+must not import the clients that are only loaded on first use. The app is
+built the way `start` does, without starting its background loops.
+
+    python -m benchmarks.import_budget [--budget-ms 2000] [--runs 5]
+
+Exits 1 on a regression, listing the slowest imports, or when startup does
+not finish within --timeout seconds.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+# Built on first use, importing any of them at startup is a regression.
+LAZY_MODULES = ('sendgrid', 'geocoder', 'bugsnag')
+BUDGET_MS = float(os.getenv('IMPORT_BUDGET_MS', 2000))
+STARTUP = 'import booker; booker.create_app()'
+TIMEOUT = 60
+TOP = 15
+
+
+def measure(statement, timeout=TIMEOUT):
+    """ Imports of a fresh interpreter: {name: (cumulative us, depth)}. """
+
+    # Startup without a .env nor a database, in dev so that Bugsnag is off.
+    env = dict(os.environ, ENV='dev', FLASK_SECRET='import-budget')
+    env.setdefault('DATABASE_URL', 'sqlite://')
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', statement],
+        env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+        universal_newlines=True, check=True, timeout=timeout)
+    imports = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports[name.strip()] = (int(cumulative), depth)
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--statement', default=STARTUP)
+    parser.add_argument('--budget-ms', type=float, default=BUDGET_MS)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--timeout', type=float, default=TIMEOUT)
+    args = parser.parse_args()
+
+    try:
+        runs = [
+            measure(args.statement, args.timeout) for _ in range(args.runs)]
+    except subprocess.TimeoutExpired:
+        print(f'FAIL: startup did not finish within {args.timeout:.0f}s')
+        return 1
+    totals = [
+        sum(us for us, depth in imports.values() if depth == 0) / 1000
+        for imports in runs]
+    best = min(totals)
+    imports = runs[totals.index(best)]
+
+    print(f'{args.statement}: {best:.0f}ms best of {args.runs} '
+          f'(budget {args.budget_ms:.0f}ms)')
+    for name, (us, depth) in sorted(
+            imports.items(), key=lambda item: -item[1][0])[:TOP]:
+        print(f'  {us / 1000:8.1f}ms  {"  " * depth}{name}')
+
+    failures = []
+    if best > args.budget_ms:
+        failures.append(f'{best:.0f}ms over the {args.budget_ms:.0f}ms budget')
+    eager = [name for name in LAZY_MODULES if name in imports]
+    if eager:
+        failures.append(f'imported at startup: {", ".join(eager)}')
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+"""
+Per-call cost of logging from the matching loop: the former synchronous
+handler with an f-string message and a per-record timezone lookup, against
+the queued handler with lazy %-style messages and the cached offset.
+
+    python -m benchmarks.logging_overhead [calls]
+"""
+import logging
+import os
+import queue
+import sys
+import time
+from datetime import datetime
+from logging.handlers import QueueListener
+from pytz import utc
+import custom_logger
+from custom_logger import (
+    BackgroundHandler, ColorStreamHandler, pacfic_timezone,
+    pacific_time_converter)
+from benchmarks.spatial_index import make_fleet
+
+
+def legacy_converter(*args):
+    utc_datetime = utc.localize(datetime.utcnow())
+    return utc_datetime.astimezone(pacfic_timezone).timetuple()
+
+
+def make_logger(name, handler, converter):
+    formatter = logging.Formatter(custom_logger.formatter._fmt,
+                                  custom_logger.formatter.datefmt)
+    formatter.converter = converter
+    handler.setFormatter(formatter)
+    log = logging.getLogger(f'benchmark.{name}')
+    log.propagate = False
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
+    return log
+
+
+def time_loop(bikes, log_call):
+    """ Seconds per iteration of a matching-style loop logging once. """
+
+    started = time.perf_counter()
+    for bike in bikes:
+        log_call(bike)
+    return (time.perf_counter() - started) / len(bikes)
+
+
+def main(calls=20000):
+    bikes = make_fleet(calls)
+    devnull = open(os.devnull, 'w')
+
+    legacy = make_logger(
+        'legacy', ColorStreamHandler(devnull), legacy_converter)
+    log_queue = queue.Queue(-1)
+    writer = ColorStreamHandler(devnull)
+    listener = QueueListener(log_queue, writer)
+    queued = make_logger(
+        'queued', BackgroundHandler(log_queue), pacific_time_converter)
+    writer.setFormatter(queued.handlers[0].formatter)
+    listener.start()
+
+    results = [
+        ('sync, f-string', time_loop(bikes, lambda bike: legacy.info(
+            f'Closest bike located at {bike.address}.'))),
+        ('queued, lazy', time_loop(bikes, lambda bike: queued.info(
+            'Closest bike located at %s.', bike.address))),
+        ('disabled, f-string', time_loop(bikes, lambda bike: queued.debug(
+            f'Closest bike located at {bike.address}.'))),
+        ('disabled, lazy', time_loop(bikes, lambda bike: queued.debug(
+            'Closest bike located at %s.', bike.address))),
+    ]
+    drain_started = time.perf_counter()
+    listener.stop()
+    drained = time.perf_counter() - drain_started
+
+    converter_calls = range(calls)
+    started = time.perf_counter()
+    for _ in converter_calls:
+        legacy_converter()
+    legacy_seconds = (time.perf_counter() - started) / calls
+    now = time.time()
+    started = time.perf_counter()
+    for _ in converter_calls:
+        pacific_time_converter(now)
+    cached_seconds = (time.perf_counter() - started) / calls
+
+    print(f'{calls} log calls')
+    for label, seconds in results:
+        print(f'{label:20s} {seconds * 1e6:8.2f} us/call')
+    print(f'{"background drain":20s} {drained * 1e3:8.1f} ms')
+    print(f'{"pytz converter":20s} {legacy_seconds * 1e6:8.2f} us/call')
+    print(f'{"cached converter":20s} {cached_seconds * 1e6:8.2f} us/call')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
@@ -0,0 +1,51 @@
+"""
+Time one batched scoring step of pending searches against a fleet, inline
+and through eventlet.tpool as the scheduler runs it.
+
+    python -m benchmarks.scoring [searches] [bikes]
+"""
+import random
+import sys
+import time
+from eventlet import tpool
+from booker.scoring import FleetArrays, Criteria, assign_bikes
+from booker.spatial import BikeIndex
+from booker.fleet import area_key
+from benchmarks.spatial_index import make_fleet, random_point
+
+
+class FakeSearch:
+    def __init__(self):
+        self.latitude, self.longitude = random_point()
+        self.area = area_key(self.latitude, self.longitude)
+        self.criteria = Criteria(
+            random.choice([25, 50]), random.choice([300, 400, 800]),
+            random.choice([None, random.uniform(0, 360)]))
+
+
+def main(searches=2000, bikes=20000):
+    random.seed(0)
+    index = BikeIndex()
+    index.apply_snapshot('sf', make_fleet(bikes))
+    fleet = FleetArrays(index)
+    pending = [FakeSearch() for _ in range(searches)]
+
+    started = time.perf_counter()
+    fleet.refresh()
+    built = time.perf_counter()
+    matches = assign_bikes(fleet, pending)
+    scored = time.perf_counter()
+    assign_bikes(fleet, pending, execute=tpool.execute)
+    offloaded = time.perf_counter()
+    tpool.killall()
+
+    print(f'{searches} searches x {bikes} bikes')
+    print(f'columnar build: {(built - started) * 1e3:8.1f} ms')
+    print(f'scoring:        {(scored - built) * 1e3:8.1f} ms')
+    print(f'scoring, tpool: {(offloaded - scored) * 1e3:8.1f} ms')
+    print(f'matched:        {sum(m is not None for m in matches):8d}')
+    print(f'distinct bikes: {len({m.id for m in matches if m}):8d}')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:3]))
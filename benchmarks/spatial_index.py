@@ -0,0 +1,76 @@
+"""
+Compare local nearest-bike queries on the BikeIndex against sorting the
+whole fleet by distance for every request, which is what the API does for
+each `sort=distance_asc` call (before adding the network round trip).
+
+    python -m benchmarks.spatial_index [fleet_size] [queries]
+"""
+import random
+import sys
+import timeit
+from booker.bikes import Bike
+from booker.spatial import BikeIndex, distance_between
+
+SF_BOUNDS = ((37.70, 37.81), (-122.51, -122.38))
+
+
+def random_point():
+    (low_lat, high_lat), (low_lng, high_lng) = SF_BOUNDS
+    return random.uniform(low_lat, high_lat), random.uniform(low_lng, high_lng)
+
+
+def make_fleet(size):
+    fleet = []
+    for bike_id in range(size):
+        latitude, longitude = random_point()
+        fleet.append(Bike(
+            bike_id, str(bike_id), '', random.randint(0, 100),
+            latitude, longitude))
+    return fleet
+
+
+def sort_query(fleet, latitude, longitude):
+    located = [
+        bike.with_distance(distance_between(
+            latitude, longitude, bike.latitude, bike.longitude))
+        for bike in fleet
+    ]
+    located.sort(key=lambda bike: bike.distance)
+    return [
+        bike for bike in located[:10]
+        if bike.ebike_battery_level >= 25 and bike.distance <= 400
+    ]
+
+
+def main(fleet_size=5000, queries=1000):
+    random.seed(0)
+    fleet = make_fleet(fleet_size)
+    points = [random_point() for _ in range(queries)]
+
+    index = BikeIndex()
+    build = timeit.timeit(
+        lambda: index.apply_snapshot('sf', fleet), number=1)
+
+    moved = random.sample(fleet, fleet_size // 10)
+    for bike in moved:
+        bike.latitude, bike.longitude = random_point()
+    update = timeit.timeit(lambda: [index.upsert(b) for b in moved], number=1)
+
+    indexed = timeit.timeit(
+        lambda: [
+            index.nearest(lat, lng, k=10, radius=400, min_battery=25)
+            for lat, lng in points],
+        number=1)
+    sorted_ = timeit.timeit(
+        lambda: [sort_query(fleet, lat, lng) for lat, lng in points],
+        number=1)
+
+    print(f'{fleet_size} bikes, {queries} queries')
+    print(f'index build:          {build * 1e3:9.2f} ms')
+    print(f'move {len(moved)} bikes:      {update * 1e3:9.2f} ms')
+    print(f'index query:          {indexed / queries * 1e6:9.1f} us/query')
+    print(f'full sort query:      {sorted_ / queries * 1e6:9.1f} us/query')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:3]))
@@ -1,24 +1,16 @@
+# Patch before anything imports threading or socket, patching afterwards
+# means walking every live object to upgrade the locks already created.
 import eventlet
-from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
-from flask_bcrypt import Bcrypt
-from flask_login import LoginManager
-from flask_socketio import SocketIO
-from dotenv import load_dotenv
-import os
-import pytz
-from datetime import datetime
 eventlet.monkey_patch()
 
-# Environment variables
-dotenv_path = os.path.join(os.path.dirname(__file__), './.env')
-load_dotenv(dotenv_path)
-SECRET_KEY = os.getenv('FLASK_SECRET')
-
-app = Flask(__name__)
-app.secret_key = SECRET_KEY
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-app.templates_auto_reload = True
+from datetime import datetime  # noqa: E402
+import pytz  # noqa: E402
+from flask import Flask  # noqa: E402
+from flask_sqlalchemy import SQLAlchemy  # noqa: E402
+from flask_bcrypt import Bcrypt  # noqa: E402
+from flask_login import LoginManager  # noqa: E402
+from flask_socketio import SocketIO  # noqa: E402
+from booker.config import Config  # noqa: E402
 
 
 # Time zone formatting
@@ -44,20 +36,52 @@ def datetimefilter(value):
     return custom_strftime('%A, %b {S}{Y} %H:%M %p', local_dt)
 
 
-app.jinja_env.filters['datetimefilter'] = datetimefilter
-
-# Security
-bcrypt = Bcrypt(app)
-login_manager = LoginManager(app)
-login_manager.login_view = 'login'
+# Extensions, bound to the app by create_app.
+bcrypt = Bcrypt()
+login_manager = LoginManager()
+login_manager.login_view = 'main.login'
 login_manager.login_message_category = 'warning'
 login_manager.login_message = 'Signup is disabled at this time'
+db = SQLAlchemy()
+
+
+class CountingSocketIO(SocketIO):
+    """ SocketIO keeping count of its live background tasks, see /metrics. """
+
+    background_tasks = 0
+
+    def start_background_task(self, target, *args, **kwargs):
+        def counted():
+            try:
+                return target(*args, **kwargs)
+            finally:
+                self.background_tasks -= 1
+
+        self.background_tasks += 1
+        return super().start_background_task(counted)
+
+
+socket = CountingSocketIO()
+
+
+def create_app(config=Config):
+    """
+    Build the app. Clients of the external services are created on first
+    use, so this only costs the imports of the web stack.
+    """
 
-# Database
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL')
-db = SQLAlchemy(app)
+    app = Flask(__name__)
+    app.config.from_object(config)
+    app.jinja_env.filters['datetimefilter'] = datetimefilter
 
-# SocketIO
-socket = SocketIO(app)
+    bcrypt.init_app(app)
+    login_manager.init_app(app)
+    db.init_app(app)
+    # Background greenlets query outside of any app context.
+    db.app = app
+    socket.init_app(
+        app, message_queue=app.config['SOCKETIO_MESSAGE_QUEUE'])
 
-from booker import routes  # noqa
+    from booker.routes import main
+    app.register_blueprint(main)
+    return app
@@ -0,0 +1,121 @@
+from collections import OrderedDict
+from math import floor
+import os
+import time
+from custom_logger import logger
+from booker import socket
+from booker.geocache import GOOGLE_API_KEY, GOOGLE_GEOCODE_URL
+
+# Cells of 0.0003 degrees, roughly 33m x 26m in San Francisco, about the
+# stretch of street a single address covers.
+ADDRESS_CELL_SIZE = 0.0003
+ADDRESS_CACHE_SIZE = int(os.getenv('ADDRESS_CACHE_SIZE', 4096))
+# Street addresses do not move, bikes come back to the same docks.
+ADDRESS_CACHE_TTL = int(os.getenv('ADDRESS_CACHE_TTL', 7 * 24 * 3600))
+# Reverse geocodes in flight at once, they only ever warm the cache.
+MAX_FILLS = 5
+# Walking speed in m/s, and how much longer than the straight line the
+# walk along the streets usually is.
+WALKING_SPEED = 1.3
+DETOUR_FACTOR = 1.3
+
+
+def walking_time(distance):
+    """ Estimated seconds to walk a straight-line distance in meters. """
+
+    return distance * DETOUR_FACTOR / WALKING_SPEED
+
+
+def google_reverse_lookup(latitude, longitude):
+    """ Street address of a point, None if it could not be found. """
+
+    import geocoder
+
+    g = geocoder.google(
+        [latitude, longitude], method='reverse', key=GOOGLE_API_KEY,
+        url=GOOGLE_GEOCODE_URL)
+    if g.status == 'OVER_QUERY_LIMIT' or g.status_code == 'Unknown':
+        logger.error(
+            'Reverse geocoding failed for %s,%s (%s)',
+            latitude, longitude, g.status)
+        return None
+    return g.address or None
+
+
+class AddressGrid:
+    """
+    Street addresses of bike locations, keyed on a grid of
+    ADDRESS_CELL_SIZE cells and kept in an in-process LRU.
+
+    Lookups never wait on the network: a cell not cached yet answers with
+    the address Social Bicycles gave the bike and gets reverse geocoded in
+    the background, so that the next bike matched there gets the street
+    address.
+    """
+
+    def __init__(self, lookup, max_size=ADDRESS_CACHE_SIZE,
+                 ttl=ADDRESS_CACHE_TTL, max_fills=MAX_FILLS):
+        self.lookup = lookup
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_fills = max_fills
+        self.entries = OrderedDict()
+        self.filling = set()
+        self.hits = 0
+        self.misses = 0
+        self.fills = 0
+
+    @staticmethod
+    def cell(latitude, longitude):
+        return (
+            floor(latitude / ADDRESS_CELL_SIZE),
+            floor(longitude / ADDRESS_CELL_SIZE))
+
+    def address(self, bike):
+        if bike.latitude is None or bike.longitude is None:
+            return bike.address
+        cell = self.cell(bike.latitude, bike.longitude)
+
+        entry = self.entries.get(cell)
+        if entry is not None and entry[0] > time.monotonic():
+            self.entries.move_to_end(cell)
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        if cell not in self.filling and len(self.filling) < self.max_fills:
+            self.filling.add(cell)
+            socket.start_background_task(
+                self.fill, cell, bike.latitude, bike.longitude)
+        return bike.address
+
+    def fill(self, cell, latitude, longitude):
+        try:
+            address = self.lookup(latitude, longitude)
+        except Exception as e:
+            logger.exception(e)
+            address = None
+        finally:
+            self.filling.discard(cell)
+        if address is None:
+            return
+
+        self.fills += 1
+        self.entries[cell] = (time.monotonic() + self.ttl, address)
+        self.entries.move_to_end(cell)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'fills': self.fills,
+            'filling': len(self.filling),
+            'hit_rate': self.hits / lookups if lookups else 0,
+        }
+
+
+address_grid = AddressGrid(google_reverse_lookup)
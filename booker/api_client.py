@@ -0,0 +1,108 @@
+import os
+import random
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from custom_logger import logger
+from metrics import registry
+from booker import socket
+
+BASE_URL = os.getenv(
+    'SOCIAL_BICYCLES_URL', 'https://app.socialbicycles.com/api')
+POOL_SIZE = int(os.getenv('SOCIAL_BICYCLES_POOL_SIZE', 10))
+TIMEOUT = float(os.getenv('SOCIAL_BICYCLES_TIMEOUT', 10))
+MAX_RETRIES = int(os.getenv('SOCIAL_BICYCLES_MAX_RETRIES', 2))
+RETRY_BACKOFF = float(os.getenv('SOCIAL_BICYCLES_RETRY_BACKOFF', 0.5))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Other methods may act twice when retried, such as booking a bike.
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+
+class SocialBicyclesClient:
+    """
+    Shared client for the Social Bicycles API. Calls go through a single
+    keep-alive session with a bounded connection pool, are retried with
+    jittered exponential backoff on 429/5xx and connection errors, and their
+    latency is recorded per endpoint. Calls that are not idempotent are only
+    retried when the connection could not be opened, the API never saw them.
+    """
+
+    def __init__(self, token, base_url=BASE_URL, pool_size=POOL_SIZE,
+                 timeout=TIMEOUT, max_retries=MAX_RETRIES,
+                 backoff=RETRY_BACKOFF):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.latencies = registry.histogram(
+            'booker_social_bicycles_request_seconds',
+            'Social Bicycles API call latency.', ('endpoint', 'status'))
+
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f'Bearer {token}'
+        # pool_block makes extra greenlets wait for a free connection instead
+        # of opening throwaway ones.
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, path, endpoint, token=None, **kwargs):
+        """
+        Send a request, with the given token instead of the shared one if
+        any, and return the last response once it succeeded or ran out of
+        retries. Connection errors are raised after the last retry.
+        """
+
+        url = f'{self.base_url}{path}'
+        kwargs.setdefault('timeout', self.timeout)
+        if token is not None:
+            kwargs['headers'] = dict(
+                kwargs.get('headers') or {}, Authorization=f'Bearer {token}')
+        idempotent = method in IDEMPOTENT_METHODS
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            logger.info('%s - %s', method, url)
+            started = time.monotonic()
+            try:
+                r = self.session.request(method, url, **kwargs)
+            except requests.RequestException as e:
+                unsent = isinstance(e, requests.exceptions.ConnectTimeout)
+                if last_attempt or not (idempotent or unsent):
+                    raise
+                logger.warn('%s %s failed (%s), retrying', method, url, e)
+                retry_after = None
+            else:
+                self.latencies.labels(endpoint, r.status_code).observe(
+                    time.monotonic() - started)
+                if (
+                    r.status_code not in RETRY_STATUSES or last_attempt or
+                    not idempotent
+                ):
+                    return r
+                logger.warn(
+                    '%s %s got %s, retrying', method, url, r.status_code)
+                retry_after = r.headers.get('Retry-After')
+
+            delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+            if retry_after and retry_after.isdigit():
+                delay = max(delay, int(retry_after))
+            socket.sleep(delay)
+
+    def get(self, path, endpoint, **kwargs):
+        return self.request('GET', path, endpoint, **kwargs)
+
+    def post(self, path, endpoint, **kwargs):
+        return self.request('POST', path, endpoint, **kwargs)
+
+    def delete(self, path, endpoint, **kwargs):
+        return self.request('DELETE', path, endpoint, **kwargs)
+
+    def latency_stats(self):
+        return {
+            f'{endpoint} {status}': histogram.summary()
+            for (endpoint, status), histogram in self.latencies.children()
+        }
+
+
+api = SocialBicyclesClient(os.getenv('SOCIAL_BICYCLES_ACCESS_TOKEN'))
@@ -0,0 +1,75 @@
+import json
+
+
+class Bike:
+    """ The few fields of a Social Bicycles bike the booker reads. """
+
+    __slots__ = (
+        'id', 'name', 'address', 'ebike_battery_level', 'latitude',
+        'longitude', 'distance')
+
+    def __init__(self, id, name, address, ebike_battery_level, latitude,
+                 longitude, distance=None):
+        self.id = id
+        self.name = name
+        self.address = address
+        self.ebike_battery_level = ebike_battery_level
+        self.latitude = latitude
+        self.longitude = longitude
+        self.distance = distance
+
+    def with_distance(self, distance):
+        """ Copy of the bike located relatively to a booking. """
+
+        return Bike(
+            self.id, self.name, self.address, self.ebike_battery_level,
+            self.latitude, self.longitude, distance)
+
+    def __repr__(self):
+        return f"Bike({self.id}, '{self.name}', '{self.address}')"
+
+
+def _keep_fields(pairs):
+    """
+    Decoder hook called for every JSON object, innermost first. Bikes become
+    Bike records, GeoJSON positions their coordinates, and every other object
+    but the top-level one is dropped as soon as it is parsed.
+    """
+
+    fields = dict(pairs)
+    if 'coordinates' in fields:
+        return fields['coordinates']
+    if 'current_position' in fields and 'id' in fields:
+        position = fields['current_position']
+        longitude, latitude = (
+            position if isinstance(position, list) and len(position) == 2
+            else (None, None))
+        return Bike(
+            fields['id'],
+            fields.get('name'),
+            fields.get('address'),
+            fields.get('ebike_battery_level') or 0,
+            latitude,
+            longitude,
+            fields.get('distance'))
+    if 'items' in fields:
+        return {'items': fields['items']}
+    return None
+
+
+def parse_bikes(text):
+    """
+    Parse a bikes.json payload into a list of Bike records, skipping items
+    that are not located bikes. Return None if the payload is malformed.
+    """
+
+    try:
+        payload = json.loads(text, object_pairs_hook=_keep_fields)
+        items = payload['items']
+    except (ValueError, TypeError, KeyError):
+        return None
+    if not isinstance(items, list):
+        return None
+    return [
+        bike for bike in items
+        if isinstance(bike, Bike) and bike.latitude is not None]
@@ -1,53 +1,59 @@
-import requests
 import os
-from dotenv import load_dotenv
 import json
-import geocoder
 import pprint
+from functools import partial
+from datetime import datetime
+from eventlet import tpool
 from custom_logger import logger
+from metrics import registry
 from flask import Response
 from flask_login import current_user
-import sendgrid
-from sendgrid.helpers.mail import Email, Content, Mail
+from requests.exceptions import ConnectTimeout
 from booker import db, socket
 from booker.models import Bookings
-
-# Environment variables.
-dotenv_path = os.path.join(os.path.dirname(__file__), './.env')
-load_dotenv(dotenv_path)
+from booker.api_client import api
+from booker.bikes import parse_bikes
+from booker.fleet import FleetPoller
+from booker.cadence import AdaptiveCadence
+from booker.scheduler import SearchScheduler
+from booker.jobs import JobWorker, VISIBILITY_TIMEOUT
+from booker.notifications import outbox_email, notification_sender
+from booker.geocache import geocode_cache
+from booker.write_behind import booking_writer
+from booker.reservations import reservations
+from booker.push import push
+from booker.booking_events import booking_events
+from booker.token_pool import token_pool
+from booker.address_grid import address_grid, walking_time
+from booker.user_stats import record_booking
+from booker import scoring
 
 # Constants.
-BASE_URL = 'https://app.socialbicycles.com/api'
-HEADERS = {
-    'Authorization': f'Bearer {os.getenv("SOCIAL_BICYCLES_ACCESS_TOKEN")}'
-}
 pp = pprint.PrettyPrinter(indent=4).pprint
 ENV = os.getenv('ENV')
-GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
 MAX_ATTEMPTS = 10 if ENV != 'dev' else 3
 RETRY_DELAY = 30 if ENV != 'dev' else 3
-sg = sendgrid.SendGridAPIClient(apikey=os.environ.get('SENDGRID_API_KEY'))
-
-
-def send_email(booking, email_address):
-    from_email = Email(os.getenv('SENDGRID_DEFAULT_SENDER'))
-    to_email = Email(email_address)
-    subject = (
-        f'Found bike {booking.matched_bike_name} '
-        f'at {booking.human_readable_address}'
-    ) if booking.status == 'match found' else (
-        'No bike found for the requested address.'
-    )
-    content = Content('text/plain', ' ')
-    mail = Mail(from_email, subject, to_email, content)
-    return sg.client.mail.send.post(request_body=mail.get())
+# Searches last as long as MAX_ATTEMPTS polls at RETRY_DELAY, but each area
+# is polled between MIN_POLL_INTERVAL and MAX_POLL_INTERVAL depending on how
+# fast its bikes come and go, see booker.cadence.
+SEARCH_WINDOW = MAX_ATTEMPTS * RETRY_DELAY
+MIN_POLL_INTERVAL = RETRY_DELAY / 6
+MAX_POLL_INTERVAL = 2 * RETRY_DELAY
+
+# Metrics.
+stage_latencies = registry.histogram(
+    'booker_stage_seconds', 'Duration of the trip pipeline stages.',
+    ('stage',))
+search_attempts = registry.histogram(
+    'booker_search_attempts', 'Search attempts per finished booking.',
+    buckets=(1, 2, 3, 5, 10, 20, 40, 60))
+booking_outcomes = registry.counter(
+    'booker_bookings_total', 'Bookings through the pipeline by outcome.',
+    ('status',))
 
 
 def create_booking(raw_query, auto_book=True):
-    g = geocoder.google(
-        f'{raw_query} San Francisco',
-        key=GOOGLE_API_KEY
-    )
+    """ Insert a pending booking, it gets located in the trip pipeline. """
 
     booking = Bookings(
         requester=current_user,
@@ -55,149 +61,155 @@ def create_booking(raw_query, auto_book=True):
         auto_book=auto_book
     )
 
-    if g.status == 'OVER_QUERY_LIMIT' or g.status_code == 'Unknown':
-        booking.status = 'error'
-        db.session.add(booking)
-        db.session.commit()
-        return booking
-
-    booking.human_readable_address = g.address
-    booking.latitude = g.latlng[0]
-    booking.longitude = g.latlng[1]
-
     db.session.add(booking)
+    record_booking(booking)
     db.session.commit()
     return booking
 
 
-def list_closest_bikes(latitude, longitude):
-    """ Fetches the 10 closest bikes of the provided coordinates """
-
-    list_url = (
-        f'{BASE_URL}/bikes.json?'
-        'per_page=10&sort=distance_asc'
-        f'&latitude={latitude}'
-        f'&longitude={longitude}')
-    logger.info(f'GET - {list_url}')
-
-    r = requests.get(
-        list_url,
-        headers=HEADERS
-    )
-
-    if r.status_code < 400 and r.status_code >= 200:
-        return r.json().get('items')
-    logger.error(
-        f'Request did not go through (code {r.status_code}):\n'
-        f'{r.text}'
-    )
-    return None
-
-
-def is_valid(bike):
+def locate_booking(booking):
     """
-    Asserts if the bikes meets certain criteria of distance and battery.
-    Will later be customizable.
+    First stage of the trip pipeline: geocode the booking query and push the
+    result to the booking page.
+    Return True if the booking could be located.
     """
 
-    return (
-        bike['ebike_battery_level'] >= 25 and
-        bike['distance'] <= 400
-    )
-
-
-def find_best_bike(booking, attempt):
-    """
-    Try MAX_ATTEMPTS time (spaced by 30 seconds) to find a close match.
-    Return False if eventually no match.
-    Return the closest bike available otherwise.
-    """
+    with stage_latencies.labels('geocode').time():
+        location = geocode_cache.get(booking.query)
 
-    bike_list = list_closest_bikes(booking.latitude, booking.longitude)
-    if bike_list is None:
+    if location is None:
+        booking_writer.update(
+            booking, status='error', geocoded_at=datetime.utcnow())
+    else:
+        booking_writer.update(
+            booking,
+            human_readable_address=location.human_readable_address,
+            latitude=location.latitude,
+            longitude=location.longitude,
+            geocoded_at=datetime.utcnow())
+
+    push('geocoded', booking.id, {
+        'address': booking.human_readable_address,
+        'status': 'info' if location is not None else 'warning'
+    })
+    return location is not None
+
+
+def list_closest_bikes(latitude, longitude, per_page=10):
+    """ Fetches the closest bikes of the provided coordinates """
+
+    lease = token_pool.for_poll()
+    if lease is None:
+        logger.info('No poll budget left, polling later')
         return None
+    account, token = lease
+    try:
+        r = api.get(
+            '/bikes.json',
+            'bikes',
+            token=token,
+            params={
+                'per_page': per_page,
+                'sort': 'distance_asc',
+                'latitude': latitude,
+                'longitude': longitude
+            }
+        )
 
-    valid_bike_list = [
-        bike for bike in bike_list
-        if is_valid(bike)
-    ]
-
-    if not valid_bike_list:
-        if attempt >= MAX_ATTEMPTS:
-            logger.warn(f'No bikes found after {attempt} attempts')
-            booking.status = 'not found'
-            db.session.add(booking)
-            db.session.commit()
-            return False
-        logger.warn('No bikes found nearby yet.')
-        socket.sleep(RETRY_DELAY)
-        return find_best_bike(booking, attempt + 1)
-
-    logger.info(
-        f'Found {len(valid_bike_list)} bikes matching criteria, '
-        'selecting the closest one.'
-    )
-
-    best_bike = min(valid_bike_list, key=lambda bike: bike['distance'])
-    logger.info(f'Closest bike located at {best_bike["address"]}.')
-    booking.matched_bike_address = best_bike['address']
-    booking.matched_bike_name = best_bike['name']
-    booking.status = 'match found'
-
-    db.session.add(booking)
-    db.session.commit()
+        if r.status_code < 400 and r.status_code >= 200:
+            bikes = parse_bikes(r.text)
+            if bikes is None:
+                logger.error('Malformed bikes.json payload:\n%s', r.text)
+            return bikes
+        if r.status_code == 429:
+            retry_after = r.headers.get('Retry-After', '')
+            token_pool.throttled(
+                account,
+                int(retry_after) if retry_after.isdigit() else RETRY_DELAY)
+        logger.error(
+            'Request did not go through (code %s):\n%s',
+            r.status_code, r.text)
+    except Exception as e:
+        logger.exception(e)
+    return None
 
-    return best_bike
 
+def find_best_bikes(searches):
+    """
+    Assign bikes to every due search against the fleet snapshots in one
+    batch, each bike being reserved for a single booking. Scoring runs in a
+    native thread so that requests keep being served meanwhile.
+    Return the bike of each search, None if there is none yet.
+    """
 
-def book_bike(bike):
+    bikes = scoring.assign_bikes(
+        fleet_arrays, searches,
+        reserve=lambda bike, search: reservations.reserve(
+            bike.id, search.booking_id),
+        execute=tpool.execute)
+    found = sum(bike is not None for bike in bikes)
+    logger.info('Found a bike for %d of %d searches.', found, len(searches))
+    return bikes
+
+
+fleet_poller = FleetPoller(list_closest_bikes, AdaptiveCadence(
+    RETRY_DELAY, MIN_POLL_INTERVAL, MAX_POLL_INTERVAL,
+    budget=token_pool.poll_budget))
+fleet_arrays = scoring.FleetArrays(fleet_poller.index)
+search_scheduler = SearchScheduler(
+    fleet_poller, find_best_bikes, SEARCH_WINDOW)
+registry.gauge(
+    'booker_pending_searches', 'Bike searches waiting for a match.',
+    function=lambda: len(search_scheduler))
+registry.gauge(
+    'booker_poll_budget_pressure',
+    'Factor stretching poll intervals to fit the API budget.',
+    function=lambda: fleet_poller.cadence.pressure())
+registry.gauge(
+    'booker_linked_accounts', 'Social Bicycles tokens in the pool.',
+    function=lambda: len(token_pool.tokens))
+
+
+def book_bike(bike, account):
     """
-    Attempt to book a bike.
-    Return True or False depending on the success.
+    Attempt to book a bike on the account of a user.
+    Return True or False depending on the success, None when the call failed
+    midway and the bike may have been booked.
     """
 
+    _, token = token_pool.for_booking(account)
     try:
-        book_url = f'{BASE_URL}/bikes/{bike["id"]}/book_bike.json'
-        logger.info(f'POST - {book_url}')
-
-        r = requests.post(
-            book_url,
-            headers=HEADERS
-        )
+        r = api.post(
+            f'/bikes/{bike.id}/book_bike.json', 'book_bike', token=token)
 
         if r.status_code >= 200 and r.status_code < 400:
-            logger.info(f'Succesfully booked bike {bike["name"]}')
+            logger.info('Succesfully booked bike %s', bike.name)
             return True
         else:
-            logger.error(
-                f'{r.status_code} - {r.text}'
-            )
+            logger.error('%s - %s', r.status_code, r.text)
             return False
+    except ConnectTimeout as e:
+        logger.exception(e)
+        return False
     except Exception as e:
         logger.exception(e)
-    return False
+    return None
 
 
-def cancel_rental():
-    """ Cancel the current active rental. """
+def cancel_rental(account):
+    """ Cancel the current active rental of a user. """
 
+    _, token = token_pool.for_booking(account)
     try:
-        cancel_url = f'{BASE_URL}/rentals/cancel.json'
-        logger.info(f'POST - {cancel_url}')
-        r = requests.delete(
-            cancel_url,
-            headers=HEADERS
-        )
+        r = api.delete('/rentals/cancel.json', 'cancel_rental', token=token)
         if r.status_code >= 200 and r.status_code < 400:
-            logger.info(f'Succesfully cancelled rental.')
+            logger.info('Succesfully cancelled rental.')
             return {
                 'message': 'Successfully cancelled rental!',
                 'category': 'success'
             }
         else:
-            logger.warn(
-                f'{r.status_code} - {json.loads(r.text)}'
-            )
+            logger.warn('%s - %s', r.status_code, r.text)
             return {
                 'message': json.loads(r.text).get('error'),
                 'category': 'info'
@@ -210,48 +222,217 @@ def cancel_rental():
     }
 
 
-def schedule_trip(booking_id, email):
+def schedule_trip(job_id, booking_id, email):
+    """
+    Locate the booking and queue a bike search, see finish_job.
+    Jobs can run more than once, so only pending bookings are handled.
+    """
+
     booking = db.session.query(Bookings).get(booking_id)
 
-    # Todo: handle auto-booking
-    if booking.status == 'error':
-        return Response(response='Error', status=429)
+    try:
+        if booking.status != 'pending':
+            logger.warn('Booking %s already %s', booking_id, booking.status)
+            job_worker.complete(job_id)
+            return Response(response='Already handled', status=200)
+
+        if booking.book_attempted_at is not None:
+            # A previous run stopped after calling book_bike, the bike may
+            # be booked already: booking again could take a second one.
+            logger.warn(
+                'Booking %s already tried to book bike %s',
+                booking_id, booking.matched_bike_name)
+            finish_interrupted(booking, email)
+            job_worker.complete(job_id)
+            return Response(response='Already handled', status=200)
+
+        # Todo: handle auto-booking
+        if not locate_booking(booking):
+            job_worker.complete(job_id)
+            return Response(response='Error', status=429)
+
+        logger.info(
+            'Searching bikes around %s', booking.human_readable_address)
+
+        search_scheduler.add(
+            booking.id, booking.latitude, booking.longitude,
+            scoring.criteria_for(booking.requester),
+            on_done=partial(
+                finish_job, email=email, job_id=job_id,
+                account=booking.requester_id))
+        return Response(response='Searching', status=202)
+    finally:
+        db.session.remove()
+
+
+def finish_job(search, candidate_bike, email, job_id, account):
+    try:
+        if finish_trip(search, candidate_bike, email, account):
+            job_worker.complete(job_id)
+    except Exception as e:
+        logger.exception('Finishing job %s failed: %s', job_id, e)
+        job_worker.abandon(job_id)
+    finally:
+        db.session.remove()
+
 
-    logger.info(
-        f'Searching bikes around {booking.human_readable_address}')
+def fail_booking(booking_id, email):
+    """
+    Give up a booking whose job failed too many times. Its error status and
+    email are committed along with the failed job, see JobWorker.lease.
+    """
 
-    candidate_bike = find_best_bike(booking, attempt=1)
+    booking = booking_writer.load(booking_id)
+    if booking is None or booking.status != 'pending':
+        return
+    booking_writer.update(
+        booking, flush=False, status='error', notified_at=datetime.utcnow())
+    booking_writer.flush(rows=[outbox_email(booking, email)])
+    notification_sender.wakeup()
+    booking_outcomes.labels(booking.status).inc()
+    socket.start_background_task(
+        push, 'booked', booking_id, {'status': 'warning'})
 
-    email_response = send_email(booking, email)
-    if email_response.status_code < 400:
-        logger.info('Email successfully sent')
-    else:
-        logger.warn(f'Email not sent (status {email_response.status_code}')
-
-    if not candidate_bike:
-        socket.emit('booked', {
-            'status': 'warning'
-        }, namespace=f'/booking_{booking.id}')
-        return Response(response='No bike around', status=404)
-
-    socket.emit(
-        'booked',
-        {
-            'address': booking.matched_bike_address,
-            'bike_name': booking.matched_bike_name,
-            'status': 'success'
-        },
-        namespace=f'/booking_{booking.id}')
+
+def finish_interrupted(booking, email):
+    """
+    Close a booking whose job stopped after trying to book its bike. It
+    may or may not have been booked, so it ends as a match.
+    """
+
+    booking_writer.update(
+        booking, flush=False, status='match found',
+        notified_at=datetime.utcnow())
+    booking_writer.flush(rows=[outbox_email(booking, email)])
+    notification_sender.wakeup()
+    booking_outcomes.labels(booking.status).inc()
+    push('booked', booking.id, {
+        'address': booking.matched_bike_address,
+        'bike_name': booking.matched_bike_name,
+        'walking_time': booking.walking_time,
+        'status': 'success'
+    })
+
+
+def note_book_attempt(booking_id, bike):
+    """
+    Durably record the bike about to be booked, or with no bike that the
+    attempt is over without a booking, see schedule_trip.
+    """
+
+    changes = {'book_attempted_at': None}
+    if bike is not None:
+        changes = {
+            'book_attempted_at': datetime.utcnow(),
+            'matched_bike_id': str(bike.id),
+            'matched_bike_name': bike.name,
+            'matched_bike_address': bike.address,
+        }
+    db.session.query(Bookings).filter(Bookings.id == booking_id).update(
+        changes, synchronize_session=False)
+    db.session.commit()
+
+
+def book_matched_bike(bike, account, booking_id):
+    """
+    Booking stage, runs right after the match.
+    Return whether the bike got booked, None when no booking was attempted
+    or its outcome is unknown.
+    """
 
     if ENV != 'dev':
-        book_bike(candidate_bike)
-        booking.status = 'booked'
-        db.session.add(booking)
-        db.session.commit()
-        return Response(response='Booked', status=200)
-
-    logger.warn(
-        f'Would have booked bike {candidate_bike["name"]} in production'
-    )
+        note_book_attempt(booking_id, bike)
+        booked = book_bike(bike, account)
+        if booked is False:
+            note_book_attempt(booking_id, None)
+        return booked
+
+    logger.warn('Would have booked bike %s in production', bike.name)
+    return None
 
-    return Response(response='Gotem', status=200)
+
+def finish_trip(search, candidate_bike, email, account):
+    """
+    Last stages of the trip pipeline. The bike is booked straight after the
+    match since other riders can take it any second, the side effects
+    (status write, email, socket push) only come after.
+    When the bike was taken in the meantime, the search goes back to the
+    scheduler and False is returned.
+    """
+
+    booked = (
+        book_matched_bike(candidate_bike, account, search.booking_id)
+        if candidate_bike
+        else None)
+    booked_at = datetime.utcnow()
+
+    if booked is False:
+        reservations.release(candidate_bike.id, search.booking_id)
+        fleet_poller.index.remove(candidate_bike.id)
+        if search_scheduler.retry(search):
+            logger.warn(
+                'Bike %s was taken, searching again', candidate_bike.name)
+            return False
+        candidate_bike = False
+
+    try:
+        booking = booking_writer.load(search.booking_id)
+        changes = {}
+
+        if candidate_bike:
+            address = address_grid.address(candidate_bike)
+            logger.info('Closest bike located at %s.', address)
+            changes.update(
+                matched_bike_address=address,
+                matched_bike_name=candidate_bike.name,
+                matched_at=search.finished_at,
+                status='booked' if booked else 'match found')
+            if candidate_bike.distance is not None:
+                changes.update(
+                    walking_distance=round(candidate_bike.distance),
+                    walking_time=round(walking_time(candidate_bike.distance)))
+            stage_latencies.labels('request_to_match').observe(
+                (search.finished_at - booking.created_at).total_seconds())
+            payload = {
+                'address': address,
+                'bike_name': candidate_bike.name,
+                'walking_time': changes.get('walking_time'),
+                'status': 'success'
+            }
+        else:
+            # None means the fleet could not be polled before the deadline.
+            changes['status'] = (
+                'not found' if candidate_bike is False else 'error')
+            payload = {'status': 'warning'}
+
+        pushed = socket.start_background_task(
+            push, 'booked', booking.id, payload)
+
+        if booked:
+            changes['booked_at'] = booked_at
+            match_to_book = (booked_at - search.finished_at).total_seconds()
+            stage_latencies.labels('match_to_book').observe(match_to_book)
+            logger.info('Booked %.0fms after match', match_to_book * 1000)
+        search_attempts.observe(search.attempt)
+        changes['notified_at'] = datetime.utcnow()
+        stage_latencies.labels('request_to_notify').observe(
+            (changes['notified_at'] - booking.created_at).total_seconds())
+
+        # Last write of the pipeline for this booking, no need to buffer it.
+        # Its email goes to the outbox in the same transaction.
+        booking_writer.update(booking, flush=False, **changes)
+        booking_writer.flush(rows=[outbox_email(booking, email)])
+        notification_sender.wakeup()
+        booking_events.save_snapshot(booking)
+        booking_outcomes.labels(booking.status).inc()
+        pushed.join()
+        return True
+    finally:
+        db.session.remove()
+
+
+# Jobs still running a lease after their search window, plus the time to
+# book and notify, are given up and retried.
+job_worker = JobWorker(
+    schedule_trip, on_lost=search_scheduler.cancel,
+    max_runtime=SEARCH_WINDOW + VISIBILITY_TIMEOUT, on_failed=fail_booking)
@@ -0,0 +1,101 @@
+from collections import OrderedDict, deque
+import json
+import os
+from booker.store import get_redis
+from booker.write_behind import TERMINAL_STATUSES
+
+# Events kept per booking, enough for geocoded + booked and a few retries.
+EVENT_LOG_SIZE = int(os.getenv('BOOKING_EVENT_LOG_SIZE', 10))
+# Booking pages are rarely opened after a day.
+EVENT_LOG_TTL = int(os.getenv('BOOKING_EVENT_LOG_TTL', 24 * 3600))
+# Bookings tracked per process when there is no Redis.
+LOCAL_BOOKINGS = 1024
+# 'match found' is where a booking ends when auto-booking is off.
+FINAL_STATUSES = TERMINAL_STATUSES | {'match found'}
+SNAPSHOT_FIELDS = (
+    'id', 'requester_id', 'status', 'human_readable_address',
+    'matched_bike_name', 'matched_bike_address', 'walking_distance',
+    'walking_time')
+EVENTS_PREFIX = 'booker:booking-events:'
+SNAPSHOT_PREFIX = 'booker:booking-snapshot:'
+
+
+def snapshot_of(booking):
+    """ The fields of a booking its page shows. """
+
+    return {field: getattr(booking, field) for field in SNAPSHOT_FIELDS}
+
+
+class BookingEvents:
+    """
+    Bounded log of the last events pushed to each booking page, replayed to
+    pages subscribing late, and snapshots of finished bookings so that their
+    page renders without a query. Kept in Redis when REDIS_URL is set, in
+    per-process LRUs otherwise.
+    """
+
+    def __init__(self, size=EVENT_LOG_SIZE, ttl=EVENT_LOG_TTL,
+                 local_bookings=LOCAL_BOOKINGS):
+        self.size = size
+        self.ttl = ttl
+        self.local_bookings = local_bookings
+        self.events = OrderedDict()
+        self.snapshots = OrderedDict()
+
+    def _remember(self, entries, key, value):
+        entries[key] = value
+        entries.move_to_end(key)
+        while len(entries) > self.local_bookings:
+            entries.popitem(last=False)
+
+    def append(self, booking_id, event, payload):
+        client = get_redis()
+        if client is not None:
+            key = f'{EVENTS_PREFIX}{booking_id}'
+            pipe = client.pipeline()
+            pipe.rpush(key, json.dumps([event, payload]))
+            pipe.ltrim(key, -self.size, -1)
+            pipe.expire(key, self.ttl)
+            pipe.execute()
+            return
+
+        log = self.events.get(booking_id)
+        if log is None:
+            log = deque(maxlen=self.size)
+        log.append((event, payload))
+        self._remember(self.events, booking_id, log)
+
+    def replay(self, booking_id):
+        """ Events of a booking, oldest first. """
+
+        client = get_redis()
+        if client is not None:
+            return [
+                tuple(json.loads(entry)) for entry in
+                client.lrange(f'{EVENTS_PREFIX}{booking_id}', 0, -1)
+            ]
+        return list(self.events.get(booking_id, ()))
+
+    def save_snapshot(self, booking):
+        """ Keep the final state of a finished booking. """
+
+        if booking.status not in FINAL_STATUSES:
+            return
+        snapshot = snapshot_of(booking)
+        client = get_redis()
+        if client is not None:
+            client.setex(
+                f'{SNAPSHOT_PREFIX}{booking.id}', self.ttl,
+                json.dumps(snapshot))
+        else:
+            self._remember(self.snapshots, booking.id, snapshot)
+
+    def snapshot(self, booking_id):
+        client = get_redis()
+        if client is not None:
+            snapshot = client.get(f'{SNAPSHOT_PREFIX}{booking_id}')
+            return json.loads(snapshot) if snapshot is not None else None
+        return self.snapshots.get(booking_id)
+
+
+booking_events = BookingEvents()
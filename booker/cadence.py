@@ -0,0 +1,69 @@
+# Share of changed bike ids between two polls at which an area is polled as
+# often as allowed.
+CHURN_SATURATION = 0.3
+# Weight of the latest poll in the churn moving average.
+CHURN_SMOOTHING = 0.5
+
+
+class AdaptiveCadence:
+    """
+    Poll interval of every area. Areas whose snapshot keeps changing, bikes
+    appearing or vanishing between two polls, are polled down to
+    min_interval, quiet ones up to max_interval. Areas never compared yet
+    start at base_interval. When all areas together would exceed budget(),
+    the calls per second this process may spend (the app takes it from the
+    token pool, see TokenPool.poll_budget), every interval is stretched by
+    the same factor.
+    """
+
+    def __init__(self, base_interval, min_interval, max_interval, budget):
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.budget = budget
+        self.churn = {}
+        self.wanted = {}
+        self.demand = 0
+
+    def observe(self, area, previous_ids, current_ids):
+        """ Record the bike ids of a new snapshot against the previous one. """
+
+        seen = previous_ids | current_ids
+        changed = len(previous_ids ^ current_ids) / len(seen) if seen else 0
+        churn = self.churn.get(area)
+        self.churn[area] = changed if churn is None else (
+            CHURN_SMOOTHING * changed + (1 - CHURN_SMOOTHING) * churn)
+
+        span = self.max_interval - self.min_interval
+        self._want(area, self.max_interval - span * min(
+            self.churn[area] / CHURN_SATURATION, 1))
+
+    def _want(self, area, interval):
+        previous = self.wanted.get(area)
+        if previous is not None:
+            self.demand -= 1 / previous
+        self.wanted[area] = interval
+        self.demand += 1 / interval
+
+    def pressure(self):
+        """ Factor stretching the intervals to fit the budget, 1 or more. """
+
+        return max(1, self.demand / self.budget())
+
+    def interval(self, area):
+        if area not in self.wanted:
+            self._want(area, self.base_interval)
+        return self.wanted[area] * self.pressure()
+
+    def forget(self, area):
+        self.churn.pop(area, None)
+        previous = self.wanted.pop(area, None)
+        if previous is not None:
+            self.demand -= 1 / previous
+
+    def stats(self):
+        return {
+            'areas': len(self.wanted),
+            'calls_per_minute': self.demand * 60,
+            'pressure': self.pressure(),
+        }
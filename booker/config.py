@@ -0,0 +1,16 @@
+"""
+Configuration of the booker, read once: booker/.env is loaded into the
+environment here, before any other module reads its settings from it.
+"""
+import os
+from dotenv import load_dotenv
+
+load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
+
+
+class Config:
+    SECRET_KEY = os.getenv('FLASK_SECRET')
+    SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URL')
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # SocketIO events go through Redis to reach the clients of every worker.
+    SOCKETIO_MESSAGE_QUEUE = os.getenv('REDIS_URL')
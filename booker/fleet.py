@@ -0,0 +1,109 @@
+import os
+import time
+from booker.spatial import BikeIndex, distance_between
+
+# Bookings whose coordinates fall in the same cell share a single poll.
+# 0.004 degrees is roughly 440m of latitude in San Francisco.
+AREA_SIZE = 0.004
+# Bikes fetched per area at first. Bikes come closest to the cell center
+# first, so dense areas get pages twice as large, up to MAX_PAGE_SIZE, until
+# they reach the max walking distance around every booking of the cell.
+AREA_PAGE_SIZE = 50
+MAX_PAGE_SIZE = int(os.getenv('SOCIAL_BICYCLES_MAX_PAGE_SIZE', 200))
+
+
+def area_key(latitude, longitude):
+    return (round(latitude / AREA_SIZE), round(longitude / AREA_SIZE))
+
+
+def area_center(area):
+    return area[0] * AREA_SIZE, area[1] * AREA_SIZE
+
+
+class FleetPoller:
+    """
+    Keep one bikes.json snapshot per area with pending bookings, fetched at
+    most once per cadence interval of the area however many bookings need
+    it, and feed it to a shared BikeIndex. Every snapshot tells the cadence
+    how much the area changed since the previous one. Snapshots reach as far
+    as the bookings of the area need, see cover.
+    """
+
+    def __init__(self, fetch, cadence):
+        self.fetch = fetch
+        self.cadence = cadence
+        self.last_polled = {}
+        self.reach = {}
+        self.page_sizes = {}
+        self.index = BikeIndex()
+        self.polls = 0
+
+    def interval(self, area):
+        return self.cadence.interval(area)
+
+    def cover(self, latitude, longitude, radius):
+        """ Make the polls of the area reach radius meters around a point. """
+
+        area = area_key(latitude, longitude)
+        reach = distance_between(
+            *area_center(area), latitude, longitude) + radius
+        self.reach[area] = max(self.reach.get(area, 0), reach)
+
+    def _truncated(self, area, bike_list, per_page):
+        """ Whether bikes within reach may have been left out of the page. """
+
+        if len(bike_list) < per_page:
+            return False
+        latitude, longitude = area_center(area)
+        return max(
+            distance_between(
+                latitude, longitude, bike.latitude, bike.longitude)
+            for bike in bike_list
+        ) < self.reach.get(area, 0)
+
+    def refresh(self, area):
+        """
+        Make sure the area snapshot is fresh, polling it if needed.
+        Return False if the poll failed.
+        """
+
+        polled_at = self.last_polled.get(area)
+        if (
+            polled_at is not None and
+            time.monotonic() - polled_at < self.interval(area)
+        ):
+            return True
+
+        latitude, longitude = area_center(area)
+        per_page = self.page_sizes.get(area, AREA_PAGE_SIZE)
+        bike_list = self.fetch(latitude, longitude, per_page=per_page)
+        self.polls += 1
+        if bike_list is None:
+            return False
+        while (
+            per_page < MAX_PAGE_SIZE and
+            self._truncated(area, bike_list, per_page)
+        ):
+            per_page = self.page_sizes[area] = min(
+                2 * per_page, MAX_PAGE_SIZE)
+            larger = self.fetch(latitude, longitude, per_page=per_page)
+            self.polls += 1
+            if larger is None:
+                break
+            bike_list = larger
+        self.last_polled[area] = time.monotonic()
+        previous_ids = self.index.area_members.get(area)
+        self.index.apply_snapshot(area, bike_list)
+        if previous_ids is not None:
+            self.cadence.observe(
+                area, previous_ids, self.index.area_members[area])
+        return True
+
+    def release(self, area):
+        """ Stop tracking an area nobody is waiting on anymore. """
+
+        self.last_polled.pop(area, None)
+        self.reach.pop(area, None)
+        self.page_sizes.pop(area, None)
+        self.index.forget_area(area)
+        self.cadence.forget(area)
@@ -1,8 +1,11 @@
 from flask_wtf import FlaskForm
 from flask_login import current_user
-from wtforms import StringField, PasswordField, SubmitField, BooleanField
+from wtforms import (
+    StringField, PasswordField, SubmitField, BooleanField, IntegerField,
+    FloatField)
 from wtforms.validators import (
-    DataRequired, Email, EqualTo, ValidationError, Length)
+    DataRequired, Email, EqualTo, ValidationError, Length, Optional,
+    NumberRange)
 from booker.models import Users
 
 MAX_USERNAME_LENGTH = 16
@@ -62,6 +65,20 @@ class UpdateAccountForm(FlaskForm):
         validators=[DataRequired(), Length(min=2, max=MAX_USERNAME_LENGTH)])
     email = StringField('Email',
                         validators=[DataRequired(), Email()])
+    min_battery_level = IntegerField(
+        'Minimum battery (%)',
+        validators=[Optional(), NumberRange(min=0, max=100)])
+    max_walking_distance = IntegerField(
+        'Maximum walking distance (m)',
+        validators=[Optional(), NumberRange(min=50, max=2000)])
+    heading = FloatField(
+        'Preferred walking direction (degrees from north)',
+        validators=[Optional(), NumberRange(min=0, max=360)])
+    # Never rendered back, an empty field keeps the linked token.
+    social_bicycles_token = PasswordField(
+        'Social Bicycles access token',
+        validators=[Optional(), Length(max=200)])
+    unlink_social_bicycles = BooleanField('Unlink my Social Bicycles account')
     submit = SubmitField('Update')
 
     def validate_username(self, username):
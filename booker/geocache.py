@@ -0,0 +1,110 @@
+from collections import OrderedDict, namedtuple
+from datetime import datetime, timedelta
+import os
+import time
+from custom_logger import logger
+from booker import db
+from booker.models import Geocodes
+
+GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
+# Unset means the geocoder default, the Google Maps API.
+GOOGLE_GEOCODE_URL = os.getenv('GOOGLE_GEOCODE_URL')
+GEOCODE_CACHE_SIZE = int(os.getenv('GEOCODE_CACHE_SIZE', 256))
+# Addresses barely move, keep them a month unless told otherwise.
+GEOCODE_CACHE_TTL = int(os.getenv('GEOCODE_CACHE_TTL', 30 * 24 * 3600))
+
+Location = namedtuple(
+    'Location', ['human_readable_address', 'latitude', 'longitude'])
+
+
+def normalize(raw_query):
+    return ' '.join(raw_query.lower().split())
+
+
+def google_lookup(query):
+    """ Geocode a query with Google, return None if it could not be done. """
+
+    # Imports every provider it supports, only pay for it when needed.
+    import geocoder
+
+    g = geocoder.google(
+        f'{query} San Francisco', key=GOOGLE_API_KEY, url=GOOGLE_GEOCODE_URL)
+    if g.status == 'OVER_QUERY_LIMIT' or g.status_code == 'Unknown':
+        logger.error('Geocoding failed for "%s" (%s)', query, g.status)
+        return None
+    if not g.latlng:
+        return None
+    return Location(g.address, g.latlng[0], g.latlng[1])
+
+
+class GeocodeCache:
+    """
+    Two-level geocoding cache: an in-process LRU in front of the Geocodes
+    table, itself in front of the Google API. Failed lookups are not cached.
+    """
+
+    def __init__(self, lookup, max_size=GEOCODE_CACHE_SIZE,
+                 ttl=GEOCODE_CACHE_TTL):
+        self.lookup = lookup
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+    def get(self, raw_query):
+        query = normalize(raw_query)
+
+        entry = self.entries.get(query)
+        if entry is not None and entry[0] > time.monotonic():
+            self.entries.move_to_end(query)
+            self.hits += 1
+            return entry[1]
+
+        row = db.session.query(Geocodes).get(query)
+        if (
+            row is not None and
+            row.created_at > datetime.utcnow() - timedelta(seconds=self.ttl)
+        ):
+            self.persistent_hits += 1
+            location = Location(
+                row.human_readable_address, row.latitude, row.longitude)
+            self._remember(query, location)
+            return location
+
+        self.misses += 1
+        location = self.lookup(query)
+        if location is None:
+            return None
+
+        self._remember(query, location)
+        db.session.merge(Geocodes(
+            query=query,
+            human_readable_address=location.human_readable_address,
+            latitude=location.latitude,
+            longitude=location.longitude,
+            created_at=datetime.utcnow()))
+        db.session.commit()
+        return location
+
+    def _remember(self, query, location):
+        self.entries[query] = (time.monotonic() + self.ttl, location)
+        self.entries.move_to_end(query)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.persistent_hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'persistent_hits': self.persistent_hits,
+            'misses': self.misses,
+            'hit_rate': (
+                (self.hits + self.persistent_hits) / lookups
+                if lookups else 0),
+        }
+
+
+geocode_cache = GeocodeCache(google_lookup)
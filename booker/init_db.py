@@ -1,14 +1,9 @@
-from booker import db, bcrypt
+from booker import db, bcrypt, create_app
 from booker.models import Users, Bookings
 import os
-from dotenv import load_dotenv
 from custom_logger import logger
 from datetime import datetime, timedelta
 
-# Environment variables.
-dotenv_path = os.path.join(os.path.dirname(__file__), './.env')
-load_dotenv(dotenv_path)
-
 
 def remake_db():
     db.session.close_all()
@@ -50,4 +45,5 @@ def remake_db():
 
 
 if __name__ == '__main__':
-    remake_db()
+    with create_app().app_context():
+        remake_db()
@@ -0,0 +1,194 @@
+from datetime import datetime, timedelta
+import os
+import platform
+import time
+from eventlet.queue import Queue, Empty
+from sqlalchemy import or_, and_
+from custom_logger import logger
+from booker import db, socket
+from booker.models import Jobs
+
+# A leased job goes back to the queue if its worker stops renewing the lease.
+VISIBILITY_TIMEOUT = int(os.getenv('JOB_VISIBILITY_TIMEOUT', 60))
+POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', 5))
+MAX_JOB_ATTEMPTS = int(os.getenv('MAX_JOB_ATTEMPTS', 3))
+# Searches a single worker runs at the same time.
+WORKER_CAPACITY = int(os.getenv('JOB_WORKER_CAPACITY', 500))
+
+
+def enqueue(booking_id, email):
+    job = Jobs(booking_id=booking_id, email=email)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+
+def available():
+    now = datetime.utcnow()
+    return or_(
+        Jobs.status == 'queued',
+        and_(Jobs.status == 'leased', Jobs.leased_until < now))
+
+
+class JobWorker:
+    """
+    Pull trip-search jobs from the Jobs table and hand them to run_job.
+
+    A job is leased for VISIBILITY_TIMEOUT seconds and the lease is renewed
+    on every poll while the job runs. If the worker dies the lease expires and
+    another worker picks the job up again, so jobs run at least once and
+    run_job has to be idempotent. Jobs whose lease was taken over, or that
+    ran for longer than max_runtime seconds, are dropped through on_lost.
+    Jobs that ran MAX_JOB_ATTEMPTS times are marked failed and handed to
+    on_failed(booking_id, email) within the same transaction.
+    """
+
+    def __init__(self, run_job, on_lost=None, capacity=WORKER_CAPACITY,
+                 max_runtime=None, on_failed=None):
+        self.run_job = run_job
+        self.on_lost = on_lost
+        self.on_failed = on_failed
+        self.capacity = capacity
+        self.max_runtime = max_runtime
+        self.name = f'{platform.node()}-{os.getpid()}'
+        self.running = {}
+        self.deadlines = {}
+        self.wakeups = Queue()
+        self.loop = None
+
+    def start(self):
+        if self.loop is None:
+            self.loop = socket.start_background_task(self.run)
+        return self.loop
+
+    def wakeup(self):
+        self.wakeups.put(None)
+
+    def run(self):
+        logger.info('Job worker %s started', self.name)
+        while True:
+            try:
+                self.renew_leases()
+                for job in self.lease(self.capacity - len(self.running)):
+                    self.running[job.id] = job.booking_id
+                    if self.max_runtime is not None:
+                        self.deadlines[job.id] = (
+                            time.monotonic() + self.max_runtime)
+                    socket.start_background_task(
+                        self._run, job.id, job.booking_id, job.email)
+            except Exception as e:
+                logger.exception('Job worker poll failed: %s', e)
+                db.session.rollback()
+            finally:
+                db.session.remove()
+
+            try:
+                self.wakeups.get(timeout=POLL_INTERVAL)
+            except Empty:
+                pass
+
+    def _run(self, job_id, booking_id, email):
+        try:
+            self.run_job(job_id, booking_id, email)
+        except Exception as e:
+            logger.exception('Job %s failed: %s', job_id, e)
+            self.abandon(job_id)
+        finally:
+            db.session.remove()
+
+    def abandon(self, job_id):
+        """
+        Stop renewing the lease of a job, it is retried once the lease
+        expires, up to MAX_JOB_ATTEMPTS times.
+        """
+
+        self.deadlines.pop(job_id, None)
+        return self.running.pop(job_id, None)
+
+    def lease(self, limit):
+        if limit <= 0:
+            return []
+
+        candidates = (
+            db.session.query(
+                Jobs.id, Jobs.attempts, Jobs.booking_id, Jobs.email)
+            .filter(available())
+            .order_by(Jobs.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .all())
+
+        leased = []
+        for job_id, attempts, booking_id, email in candidates:
+            if attempts >= MAX_JOB_ATTEMPTS:
+                logger.error('Job %s failed %d times', job_id, attempts)
+                if (
+                    self._set_status(job_id, 'failed', available()) and
+                    self.on_failed is not None
+                ):
+                    self.on_failed(booking_id, email)
+                continue
+            # The conditional update is what makes the lease exclusive,
+            # whatever the database does with FOR UPDATE.
+            claimed = (
+                db.session.query(Jobs)
+                .filter(Jobs.id == job_id, available())
+                .update({
+                    'status': 'leased',
+                    'worker': self.name,
+                    'attempts': Jobs.attempts + 1,
+                    'leased_until': self._lease_end(),
+                }, synchronize_session=False))
+            if claimed:
+                leased.append(job_id)
+        db.session.commit()
+
+        return (
+            db.session.query(Jobs).filter(Jobs.id.in_(leased)).all()
+            if leased else [])
+
+    def renew_leases(self):
+        now = time.monotonic()
+        for job_id, deadline in list(self.deadlines.items()):
+            if deadline < now:
+                logger.error(
+                    'Job %s ran for over %ss, giving it up',
+                    job_id, self.max_runtime)
+                booking_id = self.abandon(job_id)
+                if self.on_lost is not None:
+                    self.on_lost(booking_id)
+        if not self.running:
+            return
+        owned = (
+            db.session.query(Jobs)
+            .filter(
+                Jobs.id.in_(list(self.running)),
+                Jobs.worker == self.name,
+                Jobs.status == 'leased'))
+        owned.update(
+            {'leased_until': self._lease_end()}, synchronize_session=False)
+        db.session.commit()
+
+        still_owned = {job_id for job_id, in owned.with_entities(Jobs.id)}
+        for job_id in set(self.running) - still_owned:
+            booking_id = self.abandon(job_id)
+            logger.warn('Lost the lease of job %s', job_id)
+            if self.on_lost is not None:
+                self.on_lost(booking_id)
+
+    def complete(self, job_id, status='done'):
+        """ Mark a job as finished, it will not be retried anymore. """
+
+        if self.abandon(job_id) is None:
+            return
+        self._set_status(job_id, status, Jobs.worker == self.name)
+        db.session.commit()
+
+    def _set_status(self, job_id, status, *criteria):
+        return (
+            db.session.query(Jobs)
+            .filter(Jobs.id == job_id, *criteria)
+            .update({'status': status}, synchronize_session=False))
+
+    def _lease_end(self):
+        return datetime.utcnow() + timedelta(seconds=VISIBILITY_TIMEOUT)
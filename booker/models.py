@@ -1,11 +1,12 @@
 from datetime import datetime
 from booker import db, login_manager
 from flask_login import UserMixin
+from booker.user_cache import UserCache
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return Users.query.get(int(user_id))
+    return user_cache.get(int(user_id))
 
 
 class Users(db.Model, UserMixin):
@@ -14,6 +15,14 @@ class Users(db.Model, UserMixin):
     username = db.Column(db.String(20), unique=True, nullable=False)
     password = db.Column(db.String(60), nullable=False)
     admin = db.Column(db.Boolean, nullable=False, default=False)
+    # Matching criteria, the scoring defaults apply when unset.
+    min_battery_level = db.Column(db.Integer)
+    max_walking_distance = db.Column(db.Integer)
+    # Preferred walking direction in degrees from north.
+    heading = db.Column(db.Float)
+    # Bookings of the user go through their own Social Bicycles account,
+    # the shared one otherwise, and their rate budget also serves polls.
+    social_bicycles_token = db.Column(db.String(200))
     bookings = db.relationship(
         'Bookings', backref='requester', lazy=True)
 
@@ -21,6 +30,9 @@ class Users(db.Model, UserMixin):
         return f"User('{self.email}')"
 
 
+user_cache = UserCache(Users)
+
+
 class Bookings(db.Model):
     """
     Potential statuses should be pending/booked/not found/error/cancelled
@@ -36,17 +48,131 @@ class Bookings(db.Model):
 
     matched_bike_address = db.Column(db.String(200))
     matched_bike_name = db.Column(db.String(10))
+    matched_bike_id = db.Column(db.String(20))
+    # Estimated walk from the booking point to the matched bike, in meters
+    # and seconds.
+    walking_distance = db.Column(db.Integer)
+    walking_time = db.Column(db.Integer)
 
     status = db.Column(db.String(50), nullable=False, default='pending')
     auto_book = db.Column(db.Boolean, nullable=False, default=False)
     created_at = db.Column(
         db.DateTime, nullable=False, default=datetime.utcnow)
     updated_at = db.Column(
-        db.DateTime, nullable=False, default=datetime.utcnow
+        db.DateTime, nullable=False, default=datetime.utcnow,
+        onupdate=datetime.utcnow
     )
     is_deleted = db.Column(db.Boolean, nullable=False, default=False)
 
+    # Pipeline stage timestamps, to measure e.g. match-to-book latency.
+    geocoded_at = db.Column(db.DateTime)
+    matched_at = db.Column(db.DateTime)
+    booked_at = db.Column(db.DateTime)
+    notified_at = db.Column(db.DateTime)
+    # Set right before calling book_bike, so that a job running again does
+    # not book a second bike, see book_bike.schedule_trip.
+    book_attempted_at = db.Column(db.DateTime)
+
+    # Serves the history page, newest first, and its keyset pagination.
+    __table_args__ = (
+        db.Index(
+            'ix_bookings_requester_created',
+            requester_id, created_at.desc(), id.desc()),)
+
     def __repr__(self):
         return (
             f"Booking({self.id}, {self.requester_id}, '{self.created_at}',"
             f"'{self.query}')")
+
+
+class UserStats(db.Model):
+    """
+    Running summary of the bookings of a user, kept up to date on every
+    status change so that the dashboard reads one row, see booker.user_stats.
+    Counts are of bookings currently in each status.
+    """
+    user_id = db.Column(
+        db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    pending = db.Column(db.Integer, nullable=False, default=0)
+    booked = db.Column(db.Integer, nullable=False, default=0)
+    matched = db.Column(db.Integer, nullable=False, default=0)
+    not_found = db.Column(db.Integer, nullable=False, default=0)
+    errors = db.Column(db.Integer, nullable=False, default=0)
+    cancelled = db.Column(db.Integer, nullable=False, default=0)
+    # Distinct queries of the latest bookings, newest first, as JSON.
+    recent_queries = db.Column(db.Text, nullable=False, default='[]')
+    # Moving averages over the latest matches.
+    matches = db.Column(db.Integer, nullable=False, default=0)
+    match_seconds = db.Column(db.Float)
+    walking_distance = db.Column(db.Float)
+
+    def __repr__(self):
+        return f"UserStats({self.user_id}, {self.total})"
+
+
+class Geocodes(db.Model):
+    """
+    Persistent layer of the geocoding cache, keyed on the normalized query.
+    """
+    query = db.Column(db.String(100), primary_key=True)
+    human_readable_address = db.Column(db.String(200), nullable=False)
+    latitude = db.Column(db.Float(precision=5), nullable=False)
+    longitude = db.Column(db.Float(precision=5), nullable=False)
+    created_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f"Geocode('{self.query}', '{self.human_readable_address}')"
+
+
+class Jobs(db.Model):
+    """
+    Durable trip-search jobs, leased by workers for a visibility timeout.
+    Potential statuses should be queued/leased/done/failed
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    booking_id = db.Column(
+        db.Integer, db.ForeignKey('bookings.id'), nullable=False)
+    email = db.Column(db.String(100), nullable=False)
+
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    worker = db.Column(db.String(100))
+    leased_until = db.Column(db.DateTime)
+    created_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow,
+        onupdate=datetime.utcnow)
+
+    __table_args__ = (db.Index('ix_jobs_status_leased', status, leased_until),)
+
+    def __repr__(self):
+        return f"Job({self.id}, {self.booking_id}, '{self.status}')"
+
+
+class Notifications(db.Model):
+    """
+    Outbox of booking emails, sent in batches by the notification sender.
+    Potential statuses should be queued/sending/sent/failed
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    booking_id = db.Column(
+        db.Integer, db.ForeignKey('bookings.id'), nullable=False)
+    email = db.Column(db.String(100), nullable=False)
+    subject = db.Column(db.String(300), nullable=False)
+
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow)
+    created_at = db.Column(
+        db.DateTime, nullable=False, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+    __table_args__ = (
+        db.Index('ix_notifications_status_next', status, next_attempt_at),)
+
+    def __repr__(self):
+        return f"Notification({self.id}, {self.booking_id}, '{self.status}')"
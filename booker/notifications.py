@@ -0,0 +1,225 @@
+from collections import Counter
+from datetime import datetime, timedelta
+import os
+import time
+from eventlet.queue import Queue, Empty
+from custom_logger import logger
+from booker import db, socket
+from booker.models import Notifications
+
+SEND_INTERVAL = float(os.getenv('NOTIFICATION_SEND_INTERVAL', 2))
+# SendGrid accepts up to 1000 personalizations per call.
+BATCH_SIZE = int(os.getenv('NOTIFICATION_BATCH_SIZE', 100))
+MAX_SEND_ATTEMPTS = int(os.getenv('MAX_SEND_ATTEMPTS', 5))
+RETRY_BACKOFF = float(os.getenv('NOTIFICATION_RETRY_BACKOFF', 10))
+# A claimed batch goes back to the outbox if its sender died mid-call.
+CLAIM_TIMEOUT = 60
+
+_sendgrid_client = None
+
+
+def sendgrid_client():
+    """ SendGrid client, built when the first batch goes out. """
+
+    global _sendgrid_client
+    if _sendgrid_client is None:
+        import sendgrid
+
+        _sendgrid_client = sendgrid.SendGridAPIClient(
+            apikey=os.environ.get('SENDGRID_API_KEY'),
+            host=os.getenv('SENDGRID_HOST', 'https://api.sendgrid.com'))
+    return _sendgrid_client
+
+
+def outbox_email(booking, email_address):
+    """
+    Outbox row for the outcome of a booking, to be inserted along with its
+    last update, see BookingWriter.flush. The sender mails it.
+    """
+
+    if booking.status == 'error':
+        subject = 'Bikes could not be searched for the requested address.'
+    elif booking.status not in ('match found', 'booked'):
+        subject = 'No bike found for the requested address.'
+    elif booking.walking_time is None:
+        subject = (
+            f'Found bike {booking.matched_bike_name} '
+            f'at {booking.matched_bike_address}')
+    else:
+        subject = (
+            f'Found bike {booking.matched_bike_name} '
+            f'at {booking.matched_bike_address}, '
+            f'{max(1, round(booking.walking_time / 60))} min walk')
+    return Notifications(
+        booking_id=booking.id, email=email_address, subject=subject)
+
+
+def rejected(status_code):
+    """ Whether SendGrid refused the emails themselves, retrying won't do. """
+
+    return (
+        status_code is not None and 400 <= status_code < 500 and
+        status_code != 429)
+
+
+class NotificationSender:
+    """
+    Background sender draining the outbox, one SendGrid call per batch with a
+    personalization per email. Failed batches are retried with exponential
+    backoff until MAX_SEND_ATTEMPTS. A batch rejected with a 4xx, which a
+    single invalid address is enough for, is sent again one email at a
+    time; emails rejected on their own are not retried.
+    """
+
+    def __init__(self):
+        self.wakeups = Queue()
+        self.loop = None
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.batches = 0
+        self.last_batch_seconds = 0
+
+    def start(self):
+        if self.loop is None:
+            self.loop = socket.start_background_task(self.run)
+        return self.loop
+
+    def wakeup(self):
+        self.wakeups.put(None)
+
+    def run(self):
+        while True:
+            try:
+                while self.send_batch() == BATCH_SIZE:
+                    pass
+            except Exception as e:
+                logger.exception('Notification batch failed: %s', e)
+                db.session.rollback()
+            finally:
+                db.session.remove()
+
+            try:
+                self.wakeups.get(timeout=SEND_INTERVAL)
+            except Empty:
+                pass
+            # Let a burst of bookings pile up into the same batch.
+            socket.sleep(SEND_INTERVAL / 10)
+
+    def claim(self):
+        now = datetime.utcnow()
+        due = (
+            Notifications.status.in_(['queued', 'sending']),
+            Notifications.next_attempt_at <= now)
+        candidates = [
+            notification_id for notification_id, in
+            db.session.query(Notifications.id)
+            .filter(*due)
+            .order_by(Notifications.id)
+            .limit(BATCH_SIZE)
+        ]
+        claimed = []
+        for notification_id in candidates:
+            if (
+                db.session.query(Notifications)
+                .filter(Notifications.id == notification_id, *due)
+                .update({
+                    'status': 'sending',
+                    'attempts': Notifications.attempts + 1,
+                    'next_attempt_at': now + timedelta(seconds=CLAIM_TIMEOUT),
+                }, synchronize_session=False)
+            ):
+                claimed.append(notification_id)
+        db.session.commit()
+        return (
+            db.session.query(Notifications)
+            .filter(Notifications.id.in_(claimed)).all()
+            if claimed else [])
+
+    def send_batch(self):
+        """ Send one batch of due notifications, return its size. """
+
+        batch = self.claim()
+        if not batch:
+            return 0
+
+        started = time.monotonic()
+        status_code = self.post(batch)
+        if len(batch) > 1 and rejected(status_code):
+            statuses = [
+                self.post([notification]) for notification in batch]
+        else:
+            statuses = [status_code] * len(batch)
+        self.last_batch_seconds = time.monotonic() - started
+        self.batches += 1
+
+        now = datetime.utcnow()
+        outcomes = Counter()
+        for notification, status_code in zip(batch, statuses):
+            if status_code is not None and status_code < 400:
+                notification.status = 'sent'
+                notification.sent_at = now
+                self.sent += 1
+            elif (
+                rejected(status_code) or
+                notification.attempts >= MAX_SEND_ATTEMPTS
+            ):
+                notification.status = 'failed'
+                self.failed += 1
+            else:
+                notification.status = 'queued'
+                notification.next_attempt_at = now + timedelta(
+                    seconds=RETRY_BACKOFF * 2 ** (notification.attempts - 1))
+                self.retried += 1
+            outcomes[notification.status] += 1
+        db.session.commit()
+        if outcomes['sent'] == len(batch):
+            logger.info(
+                'Email batch of %d sent in %.3fs',
+                len(batch), self.last_batch_seconds)
+        else:
+            logger.warn(
+                'Email batch of %d: %d sent, %d failed, %d retried in %.3fs',
+                len(batch), outcomes['sent'], outcomes['failed'],
+                outcomes['queued'], self.last_batch_seconds)
+        return len(batch)
+
+    def post(self, notifications):
+        """ One SendGrid call, return its status, None if it got none. """
+
+        try:
+            mail = sendgrid_client().client.mail
+            return mail.send.post(request_body={
+                'personalizations': [
+                    {
+                        'to': [{'email': notification.email}],
+                        'subject': notification.subject,
+                    }
+                    for notification in notifications
+                ],
+                'from': {'email': os.getenv('SENDGRID_DEFAULT_SENDER')},
+                'content': [{'type': 'text/plain', 'value': ' '}],
+            }).status_code
+        except Exception as e:
+            # python_http_client raises on 4xx/5xx responses.
+            status_code = getattr(e, 'status_code', None)
+            logger.warn(
+                'Email call for %d not sent (%s): %s',
+                len(notifications), status_code, e)
+            return status_code
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'batches': self.batches,
+            'last_batch_seconds': self.last_batch_seconds,
+            'queued': (
+                db.session.query(Notifications)
+                .filter(Notifications.status.in_(['queued', 'sending']))
+                .count()),
+        }
+
+
+notification_sender = NotificationSender()
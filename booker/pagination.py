@@ -0,0 +1,41 @@
+from collections import namedtuple
+from datetime import datetime
+from sqlalchemy import tuple_
+
+CURSOR_FORMAT = '%Y%m%d%H%M%S%f'
+
+KeysetPage = namedtuple('KeysetPage', ['items', 'next_cursor'])
+
+
+def encode_cursor(row):
+    return f'{row.created_at.strftime(CURSOR_FORMAT)}.{row.id}'
+
+
+def decode_cursor(cursor):
+    """ Return (created_at, id) from a cursor, None if it is malformed. """
+
+    try:
+        created_at, row_id = cursor.split('.')
+        return datetime.strptime(created_at, CURSOR_FORMAT), int(row_id)
+    except (AttributeError, ValueError):
+        return None
+
+
+def keyset_paginate(query, model, cursor=None, per_page=10):
+    """
+    Paginate a query newest first on (created_at, id). Unlike OFFSET, every
+    page is a single index range scan however deep it is, and there is no
+    COUNT(*).
+    """
+
+    position = decode_cursor(cursor) if cursor else None
+    if position is not None:
+        query = query.filter(tuple_(model.created_at, model.id) < position)
+    rows = (
+        query
+        .order_by(model.created_at.desc(), model.id.desc())
+        .limit(per_page + 1)
+        .all())
+    next_cursor = encode_cursor(rows[per_page - 1]) if (
+        len(rows) > per_page) else None
+    return KeysetPage(rows[:per_page], next_cursor)
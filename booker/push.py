@@ -0,0 +1,70 @@
+import time
+from flask_login import current_user
+from flask_socketio import emit, join_room
+from metrics import registry
+from booker import db, socket
+from booker.models import Bookings
+from booker.booking_events import booking_events
+
+# Every booking page listens on this namespace, in the room of its booking.
+NAMESPACE = '/booking'
+fanout_latencies = registry.histogram(
+    'booker_push_fanout_seconds',
+    'Delay between pushing an event and a page receiving it.', ('event',))
+
+
+def booking_room(booking_id):
+    return f'booking_{booking_id}'
+
+
+def push(event, booking_id, payload):
+    """
+    Send an event to the pages of a booking, whichever worker they are
+    connected to. The send time comes along so pages can report delivery.
+    The event is also logged for the pages that subscribe later.
+    """
+
+    booking_events.append(booking_id, event, payload)
+    socket.emit(
+        event, dict(payload, sent_at=time.time()),
+        room=booking_room(booking_id), namespace=NAMESPACE)
+
+
+@socket.on('subscribe', namespace=NAMESPACE)
+def subscribe(data):
+    """
+    Join the room of a booking of the connected user, and catch up with the
+    events pushed before.
+    """
+
+    try:
+        booking = db.session.query(Bookings).get(int(data['booking_id']))
+        if (
+            booking is None or not current_user.is_authenticated or
+            booking.requester_id != current_user.id
+        ):
+            return
+        join_room(booking_room(booking.id))
+    finally:
+        db.session.remove()
+
+    for event, payload in booking_events.replay(booking.id):
+        emit(event, dict(payload, replayed=True))
+
+
+@socket.on('delivered', namespace=NAMESPACE)
+def delivered(data):
+    """ Pages acknowledge each event, measuring the fan-out latency. """
+
+    try:
+        latency = time.time() - float(data['sent_at'])
+    except (KeyError, TypeError, ValueError):
+        return
+    fanout_latencies.labels(data.get('event')).observe(max(latency, 0))
+
+
+def fanout_stats():
+    return {
+        event: histogram.summary()
+        for (event,), histogram in fanout_latencies.children()
+    }
@@ -0,0 +1,67 @@
+import os
+import time
+from booker.store import get_redis
+
+# A reservation outlives the booking POST, then the bike is fair game again.
+RESERVATION_TTL = int(os.getenv('BIKE_RESERVATION_TTL', 60))
+KEY_PREFIX = 'booker:bike-reservation:'
+# Delete a reservation only if it still belongs to the booking, in one step
+# so that a newer reservation of the bike is never dropped.
+RELEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+class Reservations:
+    """
+    Bikes promised to a booking, so that two bookings, possibly on two
+    workers, never get matched to the same bike. Kept in Redis when it is
+    configured, per process otherwise, where expired reservations are
+    pruned every ttl seconds.
+    """
+
+    def __init__(self, ttl=RESERVATION_TTL):
+        self.ttl = ttl
+        self.local = {}
+        self.pruned_at = time.monotonic()
+
+    def reserve(self, bike_id, booking_id):
+        """ Return True if the bike is now reserved for the booking. """
+
+        client = get_redis()
+        if client is not None:
+            key = f'{KEY_PREFIX}{bike_id}'
+            if client.set(key, booking_id, ex=self.ttl, nx=True):
+                return True
+            # Reserving again for the same booking is fine.
+            return client.get(key) == str(booking_id).encode()
+
+        now = time.monotonic()
+        if now - self.pruned_at > self.ttl:
+            self._prune(now)
+        holder = self.local.get(bike_id)
+        if holder is not None and holder[1] > now and holder[0] != booking_id:
+            return False
+        self.local[bike_id] = (booking_id, now + self.ttl)
+        return True
+
+    def _prune(self, now):
+        self.local = {
+            bike_id: holder for bike_id, holder in self.local.items()
+            if holder[1] > now}
+        self.pruned_at = now
+
+    def release(self, bike_id, booking_id):
+        client = get_redis()
+        if client is not None:
+            client.eval(
+                RELEASE_SCRIPT, 1, f'{KEY_PREFIX}{bike_id}', booking_id)
+            return
+        if self.local.get(bike_id, (None,))[0] == booking_id:
+            del self.local[bike_id]
+
+
+reservations = Reservations()
@@ -1,24 +1,83 @@
-from booker import app, db, bcrypt
+import time
+from booker import db, bcrypt, socket
+from metrics import registry
 from flask_login import login_user, logout_user, current_user, login_required
-from booker.models import Users, Bookings
-from booker.book_bike import create_booking, schedule_trip, cancel_rental
+from booker.models import Users, Bookings, user_cache
+from booker.book_bike import (
+    create_booking, cancel_rental, job_worker, stage_latencies, fleet_poller)
+from booker.jobs import enqueue
+from booker.geocache import geocode_cache
+from booker.api_client import api
+from booker.notifications import notification_sender
+from booker.write_behind import booking_writer
+from booker.push import fanout_stats
+from booker.token_pool import token_pool
+from booker.address_grid import address_grid
+from booker.user_stats import summary, recent_queries
+from booker.booking_events import (
+    booking_events, snapshot_of, FINAL_STATUSES)
 from booker.init_db import remake_db
+from booker.pagination import keyset_paginate
 from booker.forms import (
     AddressForm, LoginForm, RegistrationForm, UpdateAccountForm)
 from flask import (
-    request, Response, render_template, redirect, url_for,
-    flash)
-import eventlet
+    Blueprint, request, Response, render_template, redirect, url_for,
+    flash, jsonify, g, abort)
 
+main = Blueprint('main', __name__)
 
-@app.route('/', methods=['GET'])
+request_latencies = registry.histogram(
+    'booker_http_request_seconds', 'Time spent serving a request.',
+    ('endpoint',))
+responses = registry.counter(
+    'booker_http_responses_total', 'Responses sent by endpoint and status.',
+    ('endpoint', 'method', 'status'))
+booking_pages = registry.counter(
+    'booker_booking_pages_total', 'Booking pages rendered by data source.',
+    ('source',))
+# Each request and background task runs in its own greenlet, counting them
+# as they start and end is cheaper than walking the heap on every scrape.
+requests_in_flight = registry.gauge(
+    'booker_requests_in_flight', 'Requests being served.')
+registry.gauge(
+    'booker_greenlets', 'Live request and background greenlets.',
+    function=lambda: (
+        requests_in_flight.labels().value + socket.background_tasks))
+
+
+@main.before_app_request
+def start_timer():
+    g.request_started = time.monotonic()
+    requests_in_flight.labels().inc()
+
+
+@main.teardown_app_request
+def end_request(exc):
+    if 'request_started' in g:
+        requests_in_flight.labels().dec()
+
+
+@main.after_app_request
+def record_request(response):
+    endpoint = request.endpoint or 'unknown'
+    responses.labels(endpoint, request.method, response.status_code).inc()
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        request_latencies.labels(endpoint).observe(
+            time.monotonic() - started)
+    return response
+
+
+@main.route('/', methods=['GET'])
 @login_required
 def index():
     form = AddressForm()
-    return render_template('index.html', form=form)
+    return render_template(
+        'index.html', form=form,
+        recent_queries=recent_queries(summary(current_user.id)))
 
 
-@app.route('/book', methods=['POST'])
+@main.route('/book', methods=['POST'])
 @login_required
 def book():
     form = AddressForm()
@@ -28,37 +87,40 @@ def book():
 
     booking = create_booking(form.address.data, True)
 
-    eventlet.spawn(
-        schedule_trip, booking_id=booking.id, email=current_user.email)
+    enqueue(booking.id, current_user.email)
+    job_worker.wakeup()
 
-    init_data = (
-        {
-            'message': (
-                'Searching bikes around '
-                f'{booking.human_readable_address}'
-                '...'),
-            'category': 'info'
-        } if booking.status == 'pending'
-        else ({
-            'message': 'Error with Google Maps API',
-            'category': 'warning'
-        }))
-    flash(init_data['message'], init_data['category'])
+    flash(f'Locating "{booking.query}"...', 'info')
 
-    return redirect(url_for('booking_id', id=booking.id))
+    return redirect(url_for('main.booking_id', id=booking.id))
 
 
-@app.route('/booking/<id>', methods=['GET', 'PUT'])
+@main.route('/booking/<int:id>', methods=['GET', 'PUT'])
 @login_required
 def booking_id(id):
-    booking = db.session.query(Bookings).get(id)
-    return render_template('booking.html', booking=booking)
+    # Finished bookings no longer change, their page needs no query.
+    booking = booking_events.snapshot(id)
+    if booking is not None:
+        booking_pages.labels('snapshot').inc()
+    else:
+        row = db.session.query(Bookings).get(id)
+        if row is None:
+            abort(404)
+        booking_events.save_snapshot(row)
+        booking = snapshot_of(row)
+        booking_pages.labels('db').inc()
+
+    if booking['requester_id'] != current_user.id:
+        abort(404)
+    return render_template(
+        'booking.html', booking=booking,
+        finished=booking['status'] in FINAL_STATUSES)
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@main.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     form = LoginForm()
     if form.validate_on_submit():
         user = Users.query.filter_by(email=form.email.data).first()
@@ -71,18 +133,18 @@ def login():
             next_page = request.args.get('next')
             return (
                 redirect(next_page) if next_page
-                else (url_for('index')))
+                else (url_for('main.index')))
         flash(
             'Login Unsuccessful. Please check username and password',
             'danger')
     return render_template('login.html', title='Login', form=form)
 
 
-@app.route('/register', methods=['GET', 'POST'])
+@main.route('/register', methods=['GET', 'POST'])
 @login_required
 def register():
     if current_user.is_authenticated:
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     form = RegistrationForm()
     if form.validate_on_submit():
         hashed_pw = (
@@ -97,64 +159,110 @@ def register():
             user.admin = True
             db.session.commit()
         flash(f'Account created.', 'success')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     return render_template('register.html', title='Register', form=form)
 
 
-@app.route('/account', methods=['GET', 'POST'])
+@main.route('/account', methods=['GET', 'POST'])
 @login_required
 def account():
     form = UpdateAccountForm()
     if form.validate_on_submit():
         current_user.username = form.username.data
         current_user.email = form.email.data
+        current_user.min_battery_level = form.min_battery_level.data
+        current_user.max_walking_distance = form.max_walking_distance.data
+        current_user.heading = form.heading.data
+        if form.unlink_social_bicycles.data:
+            current_user.social_bicycles_token = None
+        elif form.social_bicycles_token.data:
+            current_user.social_bicycles_token = (
+                form.social_bicycles_token.data)
         db.session.commit()
+        user_cache.invalidate(current_user.id)
+        token_pool.link(current_user.id, current_user.social_bicycles_token)
         flash('Your account has been updated!', 'success')
-        return redirect(url_for('account'))
+        return redirect(url_for('main.account'))
     elif request.method == 'GET':
         form.username.data = current_user.username
         form.email.data = current_user.email
+        form.min_battery_level.data = current_user.min_battery_level
+        form.max_walking_distance.data = current_user.max_walking_distance
+        form.heading.data = current_user.heading
     return render_template(
-        'account.html', title='Account', form=form)
+        'account.html', title='Account', form=form,
+        stats=summary(current_user.id))
 
 
-@app.route('/bookings/<username>', methods=['GET'])
+@main.route('/bookings/<username>', methods=['GET'])
 @login_required
 def bookings(username):
-    page = request.args.get('page', 1, type=int)
     user = db.session.query(Users).filter_by(username=username).first_or_404()
-    booking_list = (
-        db.session.query(Bookings).filter_by(requester=user)
-        .order_by(Bookings.created_at.desc())
-        .paginate(page=page, per_page=10))
-    return render_template('bookings.html', bookings=booking_list)
+    booking_list = keyset_paginate(
+        db.session.query(Bookings).filter_by(requester=user, is_deleted=False),
+        Bookings,
+        cursor=request.args.get('before'),
+        per_page=10)
+    return render_template(
+        'bookings.html', bookings=booking_list, username=username)
 
 
-@app.route('/cancel', methods=['GET'])
+@main.route('/cancel', methods=['GET'])
 @login_required
 def cancel():
-    is_cancelled = cancel_rental()
+    is_cancelled = cancel_rental(current_user.id)
     flash(is_cancelled['message'], is_cancelled['category'])
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
 
-@app.route('/logout')
+@main.route('/logout')
 def logout():
     logout_user()
-    return redirect(url_for('index'))
+    return redirect(url_for('main.index'))
 
 
-@app.route('/authorized')
+@main.route('/authorized')
 @login_required
 def success_page():
     # Edit this later to generate auth tokens per user
     return Response(response='Yay', status=200)
 
 
-@app.route('/remake-db')
+@main.route('/remake-db')
 @login_required
 def nuke_db():
     if not current_user.admin:
         return Response('Only for admins', 403)
     remake_db()
-    return redirect(url_for('register'))
+    return redirect(url_for('main.register'))
+
+
+@main.route('/stats')
+@login_required
+def stats():
+    if not current_user.admin:
+        return Response('Only for admins', 403)
+    return jsonify(
+        geocode=geocode_cache.stats(),
+        addresses=address_grid.stats(),
+        social_bicycles=api.latency_stats(),
+        notifications=notification_sender.stats(),
+        booking_writes=booking_writer.stats(),
+        users=user_cache.stats(),
+        push=fanout_stats(),
+        polling=dict(
+            fleet_poller.cadence.stats(), polls=fleet_poller.polls),
+        tokens=token_pool.stats(),
+        pipeline={
+            stage: histogram.summary()
+            for (stage,), histogram in stage_latencies.children()
+        })
+
+
+@main.route('/metrics')
+@login_required
+def metrics():
+    if not current_user.admin:
+        return Response('Only for admins', 403)
+    return Response(
+        registry.render(), mimetype='text/plain; version=0.0.4')
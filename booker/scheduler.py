@@ -0,0 +1,213 @@
+from collections import Counter
+from datetime import datetime
+import heapq
+import itertools
+import time
+from eventlet import GreenPool
+from eventlet.queue import Queue, Empty
+from custom_logger import logger
+from booker import socket
+from booker.fleet import area_key
+
+
+class Search:
+    """ A pending bike search, small enough to keep thousands around. """
+
+    __slots__ = (
+        'booking_id', 'latitude', 'longitude', 'area', 'attempt', 'deadline',
+        'on_done', 'cancelled', 'finished_at', 'criteria', 'searched')
+
+    def __init__(self, booking_id, latitude, longitude, criteria, deadline,
+                 on_done):
+        self.booking_id = booking_id
+        self.latitude = latitude
+        self.longitude = longitude
+        self.criteria = criteria
+        self.area = area_key(latitude, longitude)
+        self.attempt = 1
+        self.deadline = deadline
+        self.on_done = on_done
+        self.cancelled = False
+        self.finished_at = None
+        # Whether a poll of its area ever went through.
+        self.searched = False
+
+
+class SearchScheduler:
+    """
+    Single loop driving every pending search from a heap of due times.
+
+    On each tick the due searches are grouped by area, each area is polled
+    once, and all due searches are matched against the fresh snapshots in a
+    single find(searches) call returning a bike or None per search. Searches
+    without a match, or whose area could not be polled or matched, are pushed
+    back by the poll interval of their area until window seconds have passed.
+    Finished searches call on_done(search, result) in a short-lived greenlet,
+    result being the bike, False when nothing was found or None when the
+    fleet could never be polled. A search whose bike could not be booked can
+    be put back with retry(search).
+    """
+
+    def __init__(self, poller, find, window, pool_size=10):
+        self.poller = poller
+        self.find = find
+        self.window = window
+        self.pool = GreenPool(pool_size)
+        self.heap = []
+        self.searches = {}
+        self.areas = Counter()
+        self.sequence = itertools.count()
+        self.wakeups = Queue()
+        self.loop = None
+
+    def __len__(self):
+        return len(self.searches)
+
+    def add(self, booking_id, latitude, longitude, criteria, on_done):
+        """ Schedule a search for a booking, its first attempt runs now. """
+
+        self.cancel(booking_id)
+        search = Search(
+            booking_id, latitude, longitude, criteria,
+            time.monotonic() + self.window, on_done)
+        self.searches[booking_id] = search
+        self.areas[search.area] += 1
+        self.poller.cover(latitude, longitude, criteria.max_distance)
+        self._push(search, time.monotonic())
+
+        if self.loop is None:
+            self.loop = socket.start_background_task(self.run)
+        self.wakeups.put(None)
+        return search
+
+    def cancel(self, booking_id):
+        """ Drop a pending search, it is skipped when its turn comes. """
+
+        search = self.searches.get(booking_id)
+        if search is None:
+            return False
+        search.cancelled = True
+        self._forget(search)
+        return True
+
+    def retry(self, search):
+        """
+        Put a finished search back, its bike having been taken before it
+        could be booked. The next attempt runs now.
+        Return False if the search is past its deadline.
+        """
+
+        if search.cancelled or time.monotonic() >= search.deadline:
+            return False
+        search.attempt += 1
+        search.finished_at = None
+        self.searches[search.booking_id] = search
+        self.areas[search.area] += 1
+        # Releasing the area when the search finished dropped its reach.
+        self.poller.cover(
+            search.latitude, search.longitude, search.criteria.max_distance)
+        self._push(search, time.monotonic())
+
+        if self.loop is None:
+            self.loop = socket.start_background_task(self.run)
+        self.wakeups.put(None)
+        return True
+
+    def _push(self, search, due):
+        heapq.heappush(self.heap, (due, next(self.sequence), search))
+
+    def _forget(self, search):
+        del self.searches[search.booking_id]
+        self.areas[search.area] -= 1
+        if not self.areas[search.area]:
+            del self.areas[search.area]
+            self.poller.release(search.area)
+
+    def _finish(self, search, result):
+        search.finished_at = datetime.utcnow()
+        self._forget(search)
+        socket.start_background_task(search.on_done, search, result)
+
+    def run(self):
+        while self.searches:
+            timeout = self.heap[0][0] - time.monotonic() if self.heap else None
+            if timeout is None or timeout > 0:
+                try:
+                    self.wakeups.get(timeout=timeout)
+                except Empty:
+                    pass
+                continue
+            try:
+                self.tick()
+            except Exception as e:
+                logger.exception('Search tick failed: %s', e)
+        self.loop = None
+
+    def tick(self):
+        now = time.monotonic()
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            _, _, search = heapq.heappop(self.heap)
+            if not search.cancelled:
+                due.append(search)
+        if not due:
+            return
+
+        areas = list({search.area for search in due})
+        logger.info(
+            '%d searches due in %d areas (%d pending)',
+            len(due), len(areas), len(self.searches))
+        polled = dict(zip(areas, self.pool.imap(self._refresh, areas)))
+
+        searchable = []
+        for search in due:
+            if search.cancelled:
+                continue
+            if not polled[search.area]:
+                self._later(search)
+            else:
+                search.searched = True
+                searchable.append(search)
+        if not searchable:
+            return
+
+        try:
+            bikes = self.find(searchable)
+        except Exception as e:
+            logger.exception(
+                'Matching %d searches failed: %s', len(searchable), e)
+            bikes = [None] * len(searchable)
+        for search, bike in zip(searchable, bikes):
+            if search.cancelled:
+                continue
+            if bike:
+                self._finish(search, bike)
+            else:
+                self._later(search)
+
+    def _refresh(self, area):
+        """ Poll an area if needed, return False if it could not be. """
+
+        try:
+            return self.poller.refresh(area)
+        except Exception as e:
+            logger.exception('Polling area %s failed: %s', area, e)
+            return False
+
+    def _later(self, search):
+        """
+        Push a search back by the poll interval of its area, or finish it
+        when that is past its deadline.
+        """
+
+        due = time.monotonic() + self.poller.interval(search.area)
+        if due <= search.deadline:
+            search.attempt += 1
+            self._push(search, due)
+        elif search.searched:
+            logger.warn('No bikes found after %d attempts', search.attempt)
+            self._finish(search, False)
+        else:
+            logger.error(
+                'Could not poll bikes for booking %s', search.booking_id)
+            self._finish(search, None)
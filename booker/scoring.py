@@ -0,0 +1,192 @@
+from collections import namedtuple, defaultdict
+import numpy as np
+from booker.spatial import EARTH_RADIUS, METERS_PER_DEGREE
+
+DEFAULT_MIN_BATTERY = 25
+DEFAULT_MAX_DISTANCE = 400
+# Weights of the score terms, each term being scaled to [0, 1].
+DISTANCE_WEIGHT = 1.0
+BATTERY_WEIGHT = 0.3
+HEADING_WEIGHT = 0.5
+# Bookings of an area scored at once, against the bikes of their bounding
+# box only.
+CHUNK_SIZE = 256
+# Best bikes of each search considered during the assignment.
+TOP_CANDIDATES = 5
+
+Criteria = namedtuple('Criteria', ['min_battery', 'max_distance', 'heading'])
+DEFAULT_CRITERIA = Criteria(DEFAULT_MIN_BATTERY, DEFAULT_MAX_DISTANCE, None)
+
+
+def criteria_for(user):
+    """ Matching criteria of a user, defaults filling the unset ones. """
+
+    return Criteria(
+        user.min_battery_level if user.min_battery_level is not None
+        else DEFAULT_MIN_BATTERY,
+        user.max_walking_distance if user.max_walking_distance is not None
+        else DEFAULT_MAX_DISTANCE,
+        user.heading)
+
+
+class FleetArrays:
+    """
+    Columnar copy of a BikeIndex sorted by latitude, rebuilt only when the
+    index changed.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.version = None
+
+    def refresh(self):
+        if self.version == self.index.version:
+            return
+        self.bikes = sorted(
+            (bike for _, bike in self.index.bikes.values()),
+            key=lambda bike: bike.latitude)
+        self.latitudes = np.array(
+            [bike.latitude for bike in self.bikes], float)
+        self.longitudes = np.array(
+            [bike.longitude for bike in self.bikes], float)
+        self.batteries = np.array(
+            [bike.ebike_battery_level for bike in self.bikes], float)
+        self.version = self.index.version
+
+    def around(self, latitudes, longitudes, radius):
+        """ Indices of the bikes in the bounding box of points + radius. """
+
+        lat_reach = radius / METERS_PER_DEGREE
+        lng_reach = lat_reach / max(
+            np.cos(np.radians(np.abs(latitudes).max() + lat_reach)), 0.01)
+        low = np.searchsorted(self.latitudes, latitudes.min() - lat_reach)
+        high = np.searchsorted(
+            self.latitudes, latitudes.max() + lat_reach, side='right')
+        longitudes_band = self.longitudes[low:high]
+        inside = (
+            (longitudes_band >= longitudes.min() - lng_reach) &
+            (longitudes_band <= longitudes.max() + lng_reach))
+        return np.nonzero(inside)[0] + low
+
+
+def score_matrix(fleet, candidates, latitudes, longitudes, criteria):
+    """
+    Score a chunk of bookings against candidate bikes, lower is better.
+    Return the (bookings x candidates) scores, inf where a bike does not meet
+    the booking criteria, along with the distances in meters.
+    """
+
+    lat = np.radians(latitudes)[:, None]
+    lng = np.radians(longitudes)[:, None]
+    bike_lat = np.radians(fleet.latitudes[candidates])[None, :]
+    bike_lng = np.radians(fleet.longitudes[candidates])[None, :]
+    batteries = fleet.batteries[candidates][None, :]
+    min_battery = np.array([c.min_battery for c in criteria], float)[:, None]
+    max_distance = np.array(
+        [c.max_distance for c in criteria], float)[:, None]
+
+    d_lat = bike_lat - lat
+    d_lng = bike_lng - lng
+    cos_lat = np.cos(lat)
+    cos_bike_lat = np.cos(bike_lat)
+    a = (
+        np.sin(d_lat / 2) ** 2 +
+        cos_lat * cos_bike_lat * np.sin(d_lng / 2) ** 2)
+    distances = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+    scores = (
+        DISTANCE_WEIGHT * distances / max_distance +
+        BATTERY_WEIGHT * (1 - batteries / 100))
+
+    # How far off their preferred walking direction the bike is, only for
+    # the users who set one.
+    rows = [i for i, c in enumerate(criteria) if c.heading is not None]
+    if rows:
+        heading = np.array([criteria[i].heading for i in rows])[:, None]
+        bearings = np.degrees(np.arctan2(
+            np.sin(d_lng[rows]) * cos_bike_lat,
+            cos_lat[rows] * np.sin(bike_lat) -
+            np.sin(lat[rows]) * cos_bike_lat * np.cos(d_lng[rows])))
+        deviation = np.abs((bearings - heading + 180) % 360 - 180)
+        scores[rows] += HEADING_WEIGHT * deviation / 180
+
+    invalid = (distances > max_distance) | (batteries < min_battery)
+    scores[invalid] = np.inf
+    return scores, distances
+
+
+def candidate_pairs(fleet, searches):
+    """
+    Score the searches against the bikes around them, chunk by chunk.
+    Return the (score, search position, bike index, distance) pairs of the
+    best bikes of each search, best score first. Only reads fleet and
+    searches, so it can run outside of the eventlet hub.
+    """
+
+    by_area = defaultdict(list)
+    for position, search in enumerate(searches):
+        by_area[search.area].append(position)
+    chunks = [
+        positions[start:start + CHUNK_SIZE]
+        for positions in by_area.values()
+        for start in range(0, len(positions), CHUNK_SIZE)
+    ]
+
+    pairs = []
+    for positions in chunks:
+        chunk = [searches[i] for i in positions]
+        latitudes = np.array([search.latitude for search in chunk], float)
+        longitudes = np.array([search.longitude for search in chunk], float)
+        criteria = [search.criteria for search in chunk]
+
+        candidates = fleet.around(
+            latitudes, longitudes, max(c.max_distance for c in criteria))
+        if not candidates.size:
+            continue
+        scores, distances = score_matrix(
+            fleet, candidates, latitudes, longitudes, criteria)
+        # A search only needs a few fallbacks should its best bikes go to
+        # closer searches.
+        top = min(TOP_CANDIDATES, candidates.size)
+        columns = np.argpartition(scores, top - 1, axis=1)[:, :top]
+        for row, position in enumerate(positions):
+            for column in columns[row]:
+                score = scores[row, column]
+                if not np.isinf(score):
+                    pairs.append((
+                        float(score), position, candidates[column],
+                        float(distances[row, column])))
+
+    pairs.sort(key=lambda pair: pair[0])
+    return pairs
+
+
+def assign_bikes(fleet, searches, reserve=None, execute=None):
+    """
+    Match the searches to bikes in batched steps, each bike going to one
+    search at most. Candidate pairs are taken greedily from the best score
+    up, a pair is kept only if reserve(bike, search) agrees, so that other
+    workers matching at the same time do not get the same bike.
+    The pairs are scored through execute(candidate_pairs, fleet, searches)
+    if given, such as eventlet.tpool.execute.
+    Return a list aligned with searches, None where no bike could be had.
+    """
+
+    results = [None] * len(searches)
+    fleet.refresh()
+    if not fleet.bikes:
+        return results
+
+    if execute is None:
+        pairs = candidate_pairs(fleet, searches)
+    else:
+        pairs = execute(candidate_pairs, fleet, searches)
+    taken = set()
+    for _, position, bike_index, distance in pairs:
+        if results[position] is not None or bike_index in taken:
+            continue
+        bike = fleet.bikes[bike_index]
+        taken.add(bike_index)
+        if reserve is None or reserve(bike, searches[position]):
+            results[position] = bike.with_distance(distance)
+    return results
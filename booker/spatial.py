@@ -0,0 +1,127 @@
+from collections import defaultdict
+from math import radians, sin, cos, asin, sqrt, floor
+import heapq
+
+# Grid cells of 0.002 degrees, roughly 220m x 175m in San Francisco.
+CELL_SIZE = 0.002
+METERS_PER_DEGREE = 111320
+EARTH_RADIUS = 6371000
+
+
+def distance_between(latitude_a, longitude_a, latitude_b, longitude_b):
+    """ Great-circle distance in meters between two points. """
+
+    d_lat = radians(latitude_b - latitude_a)
+    d_lng = radians(longitude_b - longitude_a)
+    a = (
+        sin(d_lat / 2) ** 2 +
+        cos(radians(latitude_a)) * cos(radians(latitude_b)) *
+        sin(d_lng / 2) ** 2)
+    return 2 * EARTH_RADIUS * asin(sqrt(a))
+
+
+def cell_key(latitude, longitude):
+    return (floor(latitude / CELL_SIZE), floor(longitude / CELL_SIZE))
+
+
+class BikeIndex:
+    """
+    Grid index of the bikes seen in fleet snapshots, answering nearest-bike
+    queries locally instead of asking the API to sort by distance.
+    """
+
+    def __init__(self):
+        self.cells = defaultdict(set)
+        self.bikes = {}
+        self.area_members = {}
+        # Bumped on every change, lets consumers cache derived structures.
+        self.version = 0
+
+    def __len__(self):
+        return len(self.bikes)
+
+    def upsert(self, bike):
+        cell = cell_key(bike.latitude, bike.longitude)
+        previous = self.bikes.get(bike.id)
+        if previous is not None and previous[0] != cell:
+            self._drop_from_cell(previous[0], bike.id)
+        self.bikes[bike.id] = (cell, bike)
+        self.cells[cell].add(bike.id)
+        self.version += 1
+
+    def remove(self, bike_id):
+        previous = self.bikes.pop(bike_id, None)
+        if previous is not None:
+            self._drop_from_cell(previous[0], bike_id)
+            self.version += 1
+
+    def _drop_from_cell(self, cell, bike_id):
+        members = self.cells.get(cell)
+        if members is None:
+            return
+        members.discard(bike_id)
+        if not members:
+            del self.cells[cell]
+
+    def apply_snapshot(self, area, bike_list):
+        """
+        Update the index with a fresh snapshot of an area. Bikes that were in
+        the previous snapshot of that area but are gone now have been taken.
+        """
+
+        seen = {bike.id for bike in bike_list}
+        gone = self.area_members.get(area, set()) - seen
+        self.area_members[area] = seen
+        for bike in bike_list:
+            self.upsert(bike)
+        self._release(gone)
+
+    def forget_area(self, area):
+        self._release(self.area_members.pop(area, set()))
+
+    def _release(self, bike_ids):
+        """ Remove bikes no longer reported by any tracked area. """
+
+        for bike_id in bike_ids:
+            if not any(
+                bike_id in members for members in self.area_members.values()
+            ):
+                self.remove(bike_id)
+
+    def nearest(self, latitude, longitude, k=10, radius=None, min_battery=0):
+        """
+        Return up to k bikes within radius meters with at least min_battery,
+        closest first, each annotated with its distance.
+        """
+
+        if radius is None:
+            candidates = self.bikes.keys()
+        else:
+            lat_span = radius / METERS_PER_DEGREE
+            lng_span = lat_span / max(cos(radians(latitude)), 0.01)
+            low_lat, low_lng = cell_key(
+                latitude - lat_span, longitude - lng_span)
+            high_lat, high_lng = cell_key(
+                latitude + lat_span, longitude + lng_span)
+            candidates = [
+                bike_id
+                for cell_lat in range(low_lat, high_lat + 1)
+                for cell_lng in range(low_lng, high_lng + 1)
+                for bike_id in self.cells.get((cell_lat, cell_lng), ())
+            ]
+
+        matches = []
+        for bike_id in candidates:
+            _, bike = self.bikes[bike_id]
+            if bike.ebike_battery_level < min_battery:
+                continue
+            distance = distance_between(
+                latitude, longitude, bike.latitude, bike.longitude)
+            if radius is not None and distance > radius:
+                continue
+            matches.append((distance, bike_id))
+
+        return [
+            self.bikes[bike_id][1].with_distance(distance)
+            for distance, bike_id in heapq.nsmallest(k, matches)
+        ]
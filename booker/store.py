@@ -0,0 +1,17 @@
+import os
+import redis
+
+REDIS_URL = os.getenv('REDIS_URL')
+_client = None
+
+
+def get_redis():
+    """
+    Shared Redis connection, None when REDIS_URL is not set and everything
+    falls back to per-process state.
+    """
+
+    global _client
+    if _client is None and REDIS_URL:
+        _client = redis.StrictRedis.from_url(REDIS_URL)
+    return _client
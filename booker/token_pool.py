@@ -0,0 +1,169 @@
+import os
+import time
+from sqlalchemy import select
+from custom_logger import logger
+from booker import db
+
+SHARED_ACCOUNT = 'shared'
+# Calls per second and burst allowed per token, split between the processes
+# serving the app since each keeps its own buckets.
+PROCESSES = int(os.getenv('WEB_CONCURRENCY', 1))
+TOKEN_RATE = float(os.getenv('SOCIAL_BICYCLES_TOKEN_RATE', 1)) / PROCESSES
+TOKEN_BURST = float(os.getenv('SOCIAL_BICYCLES_TOKEN_BURST', 5))
+# Calls of each bucket polls leave to bookings.
+BOOKING_RESERVE = 1
+# Tokens linked or unlinked in another process show up after this long.
+RELOAD_INTERVAL = int(os.getenv('SOCIAL_BICYCLES_TOKEN_RELOAD', 300))
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def available(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return self.tokens
+
+    def take(self):
+        self.available()
+        self.tokens -= 1
+
+    def drain(self, seconds):
+        """ Spend nothing for a while, the API asked us to back off. """
+
+        self.available()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class TokenPool:
+    """
+    Social Bicycles tokens of the shared account and of every user who
+    linked theirs, each with its own token bucket.
+
+    Bookings act on their requester's account and never wait: they may put
+    a bucket in debt. Fleet polls do not act on any account, so they go to
+    whichever token has the most spare budget, keeping BOOKING_RESERVE calls
+    of it for bookings, and are skipped when every bucket is that low. Poll
+    throughput thus grows with the number of linked accounts, see
+    poll_budget.
+    """
+
+    def __init__(self, shared_token, rate=TOKEN_RATE, burst=TOKEN_BURST,
+                 reserve=BOOKING_RESERVE, reload_interval=RELOAD_INTERVAL):
+        self.shared_token = shared_token
+        self.rate = rate
+        self.burst = burst
+        self.reserve = reserve
+        self.reload_interval = reload_interval
+        self.tokens = {}
+        self.buckets = {}
+        self.loaded_at = None
+        self.booking_calls = 0
+        self.poll_calls = 0
+        self.poll_skips = 0
+        if shared_token:
+            self.link(SHARED_ACCOUNT, shared_token)
+
+    def link(self, account, token):
+        """ Add, replace or with no token remove the token of an account. """
+
+        if not token:
+            self.tokens.pop(account, None)
+            self.buckets.pop(account, None)
+            return
+        self.tokens[account] = token
+        self.buckets.setdefault(account, TokenBucket(self.rate, self.burst))
+
+    def load(self):
+        """
+        Link the tokens of every user, again every reload_interval. Runs
+        outside of the ORM session so that callers keep theirs.
+        """
+
+        from booker.models import Users
+
+        now = time.monotonic()
+        if (
+            self.loaded_at is not None and
+            now - self.loaded_at < self.reload_interval
+        ):
+            return
+        self.loaded_at = now
+        users = Users.__table__.c
+        linked = dict(db.engine.execute(
+            select([users.id, users.social_bicycles_token])
+            .where(users.social_bicycles_token.isnot(None))).fetchall())
+        linked[SHARED_ACCOUNT] = self.shared_token
+        for account in set(self.tokens) - set(linked):
+            self.link(account, None)
+        for account, token in linked.items():
+            self.link(account, token)
+        logger.info('%d Social Bicycles tokens in the pool', len(self.tokens))
+
+    def for_booking(self, account):
+        """
+        Token to act on an account's behalf, the shared one for accounts
+        without their own. Returns (account, token).
+        """
+
+        self.load()
+        if account not in self.tokens:
+            account = SHARED_ACCOUNT
+        bucket = self.buckets.get(account)
+        if bucket is not None:
+            bucket.take()
+        self.booking_calls += 1
+        return account, self.tokens.get(account)
+
+    def for_poll(self):
+        """
+        Token with the most spare budget as (account, token), None when no
+        bucket has any so that the poll is done later instead of waited on.
+        """
+
+        self.load()
+        if not self.buckets:
+            return SHARED_ACCOUNT, None
+        account, bucket = max(
+            self.buckets.items(), key=lambda item: item[1].available())
+        if bucket.tokens < self.reserve + 1:
+            self.poll_skips += 1
+            return None
+        bucket.take()
+        self.poll_calls += 1
+        return account, self.tokens[account]
+
+    def poll_budget(self):
+        """ Calls per second this process may spend on polls. """
+
+        return self.rate * max(1, len(self.buckets))
+
+    def throttled(self, account, retry_after):
+        """ The API answered 429 to a token. """
+
+        bucket = self.buckets.get(account)
+        if bucket is not None:
+            bucket.drain(retry_after)
+
+    def stats(self):
+        return {
+            'accounts': len(self.tokens),
+            'booking_calls': self.booking_calls,
+            'poll_calls': self.poll_calls,
+            'poll_skips': self.poll_skips,
+            'budget': {
+                str(account): round(bucket.available(), 2)
+                for account, bucket in self.buckets.items()
+            },
+        }
+
+
+token_pool = TokenPool(os.getenv('SOCIAL_BICYCLES_ACCESS_TOKEN'))
@@ -0,0 +1,67 @@
+from sqlalchemy import inspect
+from booker import db, create_app
+from booker.models import Users, Bookings
+from custom_logger import logger
+
+# Columns added to tables that already exist on deployed databases, which
+# db.create_all leaves alone. They are all nullable so that existing rows
+# stay valid.
+NEW_COLUMNS = [
+    # Pipeline stage timestamps.
+    (Bookings, 'geocoded_at'),
+    (Bookings, 'matched_at'),
+    (Bookings, 'booked_at'),
+    (Bookings, 'notified_at'),
+    # Matching criteria and walking estimates.
+    (Users, 'min_battery_level'),
+    (Users, 'max_walking_distance'),
+    (Users, 'heading'),
+    (Bookings, 'walking_distance'),
+    (Bookings, 'walking_time'),
+    # Social Bicycles account of each user.
+    (Users, 'social_bicycles_token'),
+    # Booking calls that may have gone through.
+    (Bookings, 'matched_bike_id'),
+    (Bookings, 'book_attempted_at'),
+]
+# Indexes added to existing tables, by name.
+NEW_INDEXES = [
+    (Bookings, 'ix_bookings_requester_created'),
+]
+
+
+def upgrade_db():
+    """
+    Bring a database created by an older release up to the models: create
+    the new tables, then add the NEW_COLUMNS and NEW_INDEXES the existing
+    ones miss. Safe to run again, it runs on every release, see the
+    Procfile.
+    """
+
+    db.create_all()
+    inspector = inspect(db.engine)
+    for model, name in NEW_COLUMNS:
+        table = model.__table__
+        existing = {
+            column['name'] for column in inspector.get_columns(table.name)}
+        if name in existing:
+            continue
+        column_type = table.c[name].type.compile(dialect=db.engine.dialect)
+        db.engine.execute(
+            f'ALTER TABLE {table.name} ADD COLUMN {name} {column_type}')
+        logger.info('Added column %s.%s', table.name, name)
+
+    for model, name in NEW_INDEXES:
+        table = model.__table__
+        existing = {
+            index['name'] for index in inspector.get_indexes(table.name)}
+        if name in existing:
+            continue
+        index, = [index for index in table.indexes if index.name == name]
+        index.create(db.engine)
+        logger.info('Added index %s', name)
+
+
+if __name__ == '__main__':
+    with create_app().app_context():
+        upgrade_db()
@@ -0,0 +1,80 @@
+import os
+import time
+from sqlalchemy.orm import make_transient_to_detached
+from custom_logger import logger
+from booker import db, socket
+from booker.store import get_redis
+
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', 60))
+INVALIDATION_CHANNEL = 'booker:user-invalidations'
+
+
+class UserCache:
+    """
+    Per-process cache of the users loaded by Flask-Login, so authenticated
+    requests do not query Postgres for identity. Cached users are detached
+    copies merged into the request session without a SELECT.
+
+    Invalidations are published on Redis when it is configured so every
+    worker drops its copy, otherwise entries simply expire after the TTL.
+    """
+
+    def __init__(self, model, ttl=USER_CACHE_TTL):
+        self.model = model
+        self.ttl = ttl
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.listener = None
+
+    def get(self, user_id):
+        if self.listener is None and get_redis() is not None:
+            self.listener = socket.start_background_task(self.listen)
+
+        entry = self.entries.get(user_id)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return db.session.merge(entry[1], load=False)
+
+        self.misses += 1
+        user = db.session.query(self.model).get(user_id)
+        if user is not None:
+            self.entries[user_id] = (
+                time.monotonic() + self.ttl, self._copy(user))
+        return user
+
+    def _copy(self, user):
+        copy = self.model(**{
+            column.key: getattr(user, column.key)
+            for column in self.model.__mapper__.column_attrs
+        })
+        make_transient_to_detached(copy)
+        return copy
+
+    def invalidate(self, user_id):
+        self.entries.pop(user_id, None)
+        client = get_redis()
+        if client is not None:
+            client.publish(INVALIDATION_CHANNEL, user_id)
+
+    def listen(self):
+        while True:
+            try:
+                pubsub = get_redis().pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                for message in pubsub.listen():
+                    self.entries.pop(int(message['data']), None)
+            except Exception as e:
+                # Invalidations may have been missed meanwhile.
+                logger.exception('User invalidation listener failed: %s', e)
+                self.entries.clear()
+                socket.sleep(5)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0,
+        }
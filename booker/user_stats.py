@@ -0,0 +1,195 @@
+from collections import Counter
+import json
+import os
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from booker import db
+from booker.models import Bookings, UserStats
+
+# Queries offered for one-click re-booking.
+RECENT_QUERIES = int(os.getenv('RECENT_QUERIES', 5))
+# Weight of the latest match in the moving averages.
+MATCH_SMOOTHING = 0.2
+# Latest matches a rebuilt summary averages over.
+REBUILD_MATCHES = 50
+STATUS_COLUMNS = {
+    'pending': 'pending',
+    'booked': 'booked',
+    'match found': 'matched',
+    'not found': 'not_found',
+    'error': 'errors',
+    'cancelled': 'cancelled',
+}
+
+
+def _average(average, value):
+    if average is None:
+        return value
+    return MATCH_SMOOTHING * value + (1 - MATCH_SMOOTHING) * average
+
+
+def _smoothed(average, value):
+    """ SQL moving average, starting from value when there is none yet. """
+
+    return func.coalesce(
+        MATCH_SMOOTHING * value + (1 - MATCH_SMOOTHING) * average, value)
+
+
+def rebuild(user_id):
+    """
+    Compute the summary of a user from their whole history, for users who
+    booked before summaries existed. Added to the session, not committed.
+    """
+
+    stats = UserStats(user_id=user_id, total=0, matches=0)
+    for column in STATUS_COLUMNS.values():
+        setattr(stats, column, 0)
+    for status, count in (
+        db.session.query(Bookings.status, func.count())
+        .filter(Bookings.requester_id == user_id)
+        .group_by(Bookings.status)
+    ):
+        stats.total += count
+        if status in STATUS_COLUMNS:
+            setattr(stats, STATUS_COLUMNS[status], count)
+
+    queries = []
+    for query, in (
+        db.session.query(Bookings.query)
+        .filter(Bookings.requester_id == user_id)
+        .order_by(Bookings.created_at.desc())
+        .limit(RECENT_QUERIES * 10)
+    ):
+        if query not in queries and len(queries) < RECENT_QUERIES:
+            queries.append(query)
+    stats.recent_queries = json.dumps(queries)
+
+    latest = (
+        db.session.query(
+            Bookings.created_at, Bookings.matched_at,
+            Bookings.walking_distance)
+        .filter(
+            Bookings.requester_id == user_id,
+            Bookings.matched_at.isnot(None))
+        .order_by(Bookings.matched_at.desc())
+        .limit(REBUILD_MATCHES)
+        .all())
+    for created_at, matched_at, distance in reversed(latest):
+        stats.matches += 1
+        stats.match_seconds = _average(
+            stats.match_seconds, (matched_at - created_at).total_seconds())
+        if distance is not None:
+            stats.walking_distance = _average(
+                stats.walking_distance, distance)
+
+    db.session.add(stats)
+    return stats
+
+
+def _insert(user_id):
+    """
+    Rebuild and insert the summary of a user in a savepoint. Return None
+    when a concurrent request inserted it first, the caller's transaction
+    going on untouched.
+    """
+
+    try:
+        with db.session.begin_nested():
+            return rebuild(user_id)
+    except IntegrityError:
+        return None
+
+
+def summary(user_id):
+    """ The summary of a user, built from their history the first time. """
+
+    stats = db.session.query(UserStats).get(user_id)
+    if stats is None:
+        stats = (
+            _insert(user_id) or db.session.query(UserStats).get(user_id))
+        db.session.commit()
+    return stats
+
+
+def recent_queries(stats):
+    return json.loads(stats.recent_queries)
+
+
+def record_booking(booking):
+    """
+    Count a new booking in the summary of its requester, within the
+    transaction inserting it.
+    """
+
+    db.session.flush()
+    stats = db.session.query(UserStats).get(booking.requester_id)
+    if stats is None:
+        # Rebuilt with the new booking already in.
+        if _insert(booking.requester_id) is not None:
+            return
+        stats = db.session.query(UserStats).get(booking.requester_id)
+
+    stats.total = UserStats.total + 1
+    stats.pending = UserStats.pending + 1
+    queries = [booking.query] + [
+        query for query in recent_queries(stats) if query != booking.query]
+    stats.recent_queries = json.dumps(queries[:RECENT_QUERIES])
+
+
+class SummaryChanges:
+    """
+    Changes to user summaries caused by buffered booking updates, written
+    in the same transaction as the bookings, see BookingWriter. Counts move
+    from the old status to the new one; matches feed the moving averages.
+    """
+
+    def __init__(self):
+        self.pending = {}
+
+    def _changes(self, user_id):
+        return self.pending.setdefault(user_id, (Counter(), []))
+
+    def transition(self, user_id, old_status, new_status):
+        counts, _ = self._changes(user_id)
+        if old_status in STATUS_COLUMNS:
+            counts[STATUS_COLUMNS[old_status]] -= 1
+        if new_status in STATUS_COLUMNS:
+            counts[STATUS_COLUMNS[new_status]] += 1
+
+    def matched(self, user_id, seconds, walking_distance):
+        self._changes(user_id)[1].append((seconds, walking_distance))
+
+    def take(self):
+        batch, self.pending = self.pending, {}
+        return batch
+
+    def restore(self, batch):
+        """ Put back changes whose transaction failed. """
+
+        for user_id, (counts, matches) in batch.items():
+            pending_counts, pending_matches = self._changes(user_id)
+            pending_counts.update(counts)
+            pending_matches[:0] = matches
+
+    def write(self, batch):
+        """ Add the updates of a batch to the session, atomic per column. """
+
+        for user_id, (counts, matches) in batch.items():
+            values = {
+                getattr(UserStats, column): getattr(UserStats, column) + delta
+                for column, delta in counts.items() if delta
+            }
+            if matches:
+                seconds = UserStats.match_seconds
+                distance = UserStats.walking_distance
+                for match_seconds, walking_distance in matches:
+                    seconds = _smoothed(seconds, match_seconds)
+                    if walking_distance is not None:
+                        distance = _smoothed(distance, walking_distance)
+                values[UserStats.matches] = UserStats.matches + len(matches)
+                values[UserStats.match_seconds] = seconds
+                values[UserStats.walking_distance] = distance
+            if values:
+                db.session.query(UserStats).filter(
+                    UserStats.user_id == user_id
+                ).update(values, synchronize_session=False)
@@ -0,0 +1,157 @@
+from datetime import datetime
+import os
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm.attributes import set_committed_value
+from custom_logger import logger
+from booker import db, socket
+from booker.models import Bookings
+from booker.user_stats import SummaryChanges
+
+FLUSH_INTERVAL = float(os.getenv('BOOKING_FLUSH_INTERVAL', 1))
+TERMINAL_STATUSES = {'booked', 'not found', 'error', 'cancelled'}
+
+
+class BookingWriter:
+    """
+    Write-behind buffer for booking updates. Changes from every booking are
+    merged per booking and written in a single transaction each
+    FLUSH_INTERVAL, or right away when a booking reaches a terminal status.
+    The summaries of the requesters follow in the same transaction, as well
+    as rows inserted along, see flush.
+
+    When the database is unreachable the batch is kept for the next flush.
+    Any other failure writes each booking on its own, dropping those that
+    still fail so that a single bad row does not hold up every write.
+    """
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        self.pending = {}
+        self.inserts = []
+        self.summaries = SummaryChanges()
+        self.loop = None
+        self.flushes = 0
+        self.rows_written = 0
+        self.rows_dropped = 0
+
+    def update(self, booking, flush=None, **fields):
+        """
+        Buffer changes to a booking. They are visible on the booking object
+        right away without making it dirty in the session.
+        They are written right away with flush, or when the booking reaches
+        a terminal status unless flush is False.
+        """
+
+        fields['updated_at'] = datetime.utcnow()
+        status = fields.get('status')
+        if status is not None and status != booking.status:
+            self.summaries.transition(
+                booking.requester_id, booking.status, status)
+        if fields.get('matched_at') is not None:
+            self.summaries.matched(
+                booking.requester_id,
+                (fields['matched_at'] - booking.created_at).total_seconds(),
+                fields.get('walking_distance'))
+        for key, value in fields.items():
+            set_committed_value(booking, key, value)
+        self.pending.setdefault(booking.id, {}).update(fields)
+
+        if flush or (
+            flush is None and fields.get('status') in TERMINAL_STATUSES
+        ):
+            self.flush()
+        elif self.loop is None:
+            self.loop = socket.start_background_task(self.run)
+
+    def load(self, booking_id):
+        """ Get a booking with its buffered changes applied. """
+
+        booking = db.session.query(Bookings).get(booking_id)
+        for key, value in self.pending.get(booking_id, {}).items():
+            set_committed_value(booking, key, value)
+        return booking
+
+    def flush(self, rows=()):
+        """
+        Write the buffered changes, with rows to insert in the same
+        transaction, such as the outbox email of a booking.
+        """
+
+        self.inserts.extend(rows)
+        if not self.pending and not self.inserts:
+            return
+        batch, self.pending = self.pending, {}
+        inserts, self.inserts = self.inserts, []
+        summaries = self.summaries.take()
+        try:
+            self._write(batch, inserts, summaries)
+        except OperationalError:
+            self.summaries.restore(summaries)
+            self.inserts[:0] = inserts
+            # Put the batch back without overriding newer changes.
+            for booking_id, fields in batch.items():
+                self.pending[booking_id] = dict(
+                    fields, **self.pending.get(booking_id, {}))
+            raise
+        except Exception as e:
+            logger.exception(
+                'Flush of %d bookings failed, writing them one by one: %s',
+                len(batch), e)
+            self._write_each(batch, inserts, summaries)
+        self.flushes += 1
+
+    def _write(self, batch, inserts, summaries):
+        try:
+            db.session.bulk_update_mappings(Bookings, [
+                dict(fields, id=booking_id)
+                for booking_id, fields in batch.items()
+            ])
+            db.session.add_all(inserts)
+            self.summaries.write(summaries)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        self.rows_written += len(batch)
+
+    def _write_each(self, batch, inserts, summaries):
+        for booking_id, fields in batch.items():
+            try:
+                self._write({booking_id: fields}, [
+                    row for row in inserts
+                    if getattr(row, 'booking_id', None) == booking_id
+                ], {})
+            except Exception as e:
+                self.rows_dropped += 1
+                logger.exception(
+                    'Dropped changes to booking %s: %s (%s)',
+                    booking_id, fields, e)
+        try:
+            self._write({}, [
+                row for row in inserts
+                if getattr(row, 'booking_id', None) not in batch
+            ], summaries)
+        except Exception as e:
+            logger.exception('Dropped summary changes: %s (%s)', summaries, e)
+
+    def run(self):
+        while self.pending:
+            socket.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception('Booking flush failed: %s', e)
+            finally:
+                db.session.remove()
+        self.loop = None
+
+    def stats(self):
+        return {
+            'pending': len(self.pending),
+            'flushes': self.flushes,
+            'rows_written': self.rows_written,
+            'rows_dropped': self.rows_dropped,
+        }
+
+
+booking_writer = BookingWriter()
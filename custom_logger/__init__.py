@@ -1,28 +1,44 @@
 from __future__ import print_function
+import atexit
+import json
 import os
+import queue
 import sys
-import dotenv
+import time
 from pytz import utc, timezone
 from datetime import datetime
 import logging
-import bugsnag
-from bugsnag.handlers import BugsnagHandler
+from logging.handlers import QueueHandler, QueueListener
+from metrics import registry
 
-# Environment variables.
-dotenv_path = os.path.join(os.path.dirname(__file__), './.env')
-dotenv.load_dotenv(dotenv_path)
+# Settings come from the environment, which the app loads once, see
+# booker.config.
 ''' Base logging config '''
 pacfic_timezone = timezone('America/Los_Angeles')
 env = os.getenv('ENV')
-
-
-def pacific_time_converter(*args):
-    utc_datetime = utc.localize(datetime.utcnow())
-    converted = utc_datetime.astimezone(pacfic_timezone)
-    return converted.timetuple()
-
-
-logging.Formatter.converter = pacific_time_converter
+# LOG_FORMAT=json outputs one JSON object per line for log aggregators.
+log_format = os.getenv('LOG_FORMAT', 'text')
+# UTC offsets only change on the hour, one lookup per hour is enough.
+_offset_cache = [None, None, 0]
+
+
+def pacific_time_converter(timestamp=None):
+    if timestamp is None:
+        timestamp = time.time()
+    start, end, offset = _offset_cache
+    if start is None or not start <= timestamp < end:
+        start = timestamp - timestamp % 3600
+        offset = utc.localize(datetime.utcfromtimestamp(start)).astimezone(
+            pacfic_timezone).utcoffset().total_seconds()
+        _offset_cache[:] = start, start + 3600, offset
+    return time.gmtime(timestamp + offset)
+
+
+logging.Formatter.converter = staticmethod(pacific_time_converter)
+# The formats never show them, and thread lookups are slow under eventlet.
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
 
 formatter = logging.Formatter(
     '%(asctime)s.%(msecs)03d (PDT) -- jump-booker'
@@ -30,6 +46,27 @@ formatter = logging.Formatter(
     datefmt='%Y-%m-%d %H:%M:%S')
 
 
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per record, extra fields included. """
+
+    RESERVED = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record, '%Y-%m-%dT%H:%M:%S'),
+            'level': record.levelname,
+            'message': record.getMessage(),
+        }
+        entry.update(
+            (key, value) for key, value in vars(record).items()
+            if key not in self.RESERVED)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
 class ColorStreamHandler(logging.StreamHandler):
     DEFAULT = '\x1b[0m'
     RED = '\x1b[31m'
@@ -67,15 +104,39 @@ class ColorStreamHandler(logging.StreamHandler):
         return color + text + self.DEFAULT
 
 
-handler = ColorStreamHandler()
-handler.setFormatter(formatter)
+if log_format == 'json':
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter())
+else:
+    handler = ColorStreamHandler()
+    handler.setFormatter(formatter)
+
+
+class BackgroundHandler(QueueHandler):
+    """
+    Callers only enqueue records, the listener thread formats and writes
+    them. Records stay in process, so unlike QueueHandler nothing is
+    formatted upfront to make them picklable.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+log_queue = queue.Queue(-1)
+listener = QueueListener(log_queue, handler, respect_handler_level=True)
+listener.start()
+atexit.register(listener.stop)
 
 logger = logging.getLogger(__name__)
-logger.addHandler(handler)
+logger.addHandler(BackgroundHandler(log_queue))
 logger.setLevel(logging.INFO)
 
 ''' Bugsnag config '''
 if env != 'dev':
+    import bugsnag
+    from bugsnag.handlers import BugsnagHandler
+
     bugsnag.configure(api_key=os.getenv('BUGSNAG_KEY'))
     bugsnag_handler = BugsnagHandler()
     # Error types of logs are output to Bugsnag.
@@ -83,21 +144,34 @@ if env != 'dev':
     logger.addHandler(bugsnag_handler)
 
 
+function_calls = registry.counter(
+    'booker_function_calls_total', 'Calls of logged functions by outcome.',
+    ('function', 'outcome'))
+function_latencies = registry.histogram(
+    'booker_function_seconds', 'Duration of logged functions.',
+    ('function',))
+
+
 def log_function(function):
     ''' Main logging decorator '''
 
+    function_name = function.__name__
+    latencies = function_latencies.labels(function_name)
+
     def wrapper(*args, **kwargs):
-        function_name = function.__name__
-        logger.info('Executing "{0}"'.format(function_name))
+        logger.info('Executing "%s"', function_name)
         result = None
+        started = time.monotonic()
         try:
             result = function(*args, **kwargs)
         except Exception as e:
+            function_calls.labels(function_name, 'error').inc()
             logger.exception(
-                f'Exception {e} with function "{function_name}"'
-            )
+                'Exception %s with function "%s"', e, function_name)
             pass
         else:
-            logger.info(f'"{function_name}" succesfully executed!')
+            function_calls.labels(function_name, 'ok').inc()
+            logger.info('"%s" succesfully executed!', function_name)
+        latencies.observe(time.monotonic() - started)
         return result
     return wrapper
@@ -0,0 +1,171 @@
+"""
+Drive /book -> schedule_trip for concurrent users against the stand-ins and
+report throughput, match latency, greenlets, memory and DB connections.
+
+    python -m loadtest.run [--users 200] [--concurrency 50]
+        [--database-url sqlite:////tmp/booker-loadtest.db]
+        [--latency socialbicycles=0.2] [--failure socialbicycles=0.05]
+
+The database is dropped and recreated, never point it at a real one.
+"""
+import argparse
+import gc
+import os
+import resource
+import sys
+import time
+from loadtest.standins import (
+    FIXTURES_DIR, StandIns, env_for, serve, service_rates)
+
+DEFAULT_DATABASE_URL = 'sqlite:////tmp/booker-loadtest.db'
+SAMPLE_INTERVAL = 0.5
+
+
+def percentile(values, share):
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--database-url', default=DEFAULT_DATABASE_URL)
+    parser.add_argument('--fixtures', default=FIXTURES_DIR)
+    parser.add_argument('--latency', action='append', metavar='SERVICE=S')
+    parser.add_argument('--failure', action='append', metavar='SERVICE=P')
+    parser.add_argument('--timeout', type=float, default=120)
+    # Anything but dev, so that matched bikes get booked.
+    parser.add_argument('--env', default='loadtest')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    standins = StandIns(
+        args.fixtures, service_rates(args.latency),
+        service_rates(args.failure), spread=True)
+
+    # The booker reads its configuration at import time.
+    import eventlet
+    eventlet.monkey_patch()
+    port = serve(standins)
+    os.environ.update(env_for(port))
+    os.environ.update(
+        ENV=args.env, DATABASE_URL=args.database_url,
+        FLASK_SECRET=os.getenv('FLASK_SECRET', 'loadtest'))
+
+    from sqlalchemy import event
+    from greenlet import greenlet
+    from booker import create_app, db, bcrypt
+    from booker.models import Users, Bookings
+    from booker.book_bike import job_worker
+    from booker.notifications import notification_sender
+    from booker.write_behind import TERMINAL_STATUSES
+
+    app = create_app()
+    app.config['WTF_CSRF_ENABLED'] = False
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        # Logins are not what is measured.
+        password = bcrypt.generate_password_hash('loadtest', 4).decode()
+        db.session.bulk_save_objects([
+            Users(username=f'user{i}', email=f'user{i}@example.com',
+                  password=password)
+            for i in range(args.users)
+        ])
+        db.session.commit()
+
+    connections = {'open': 0, 'peak': 0}
+
+    @event.listens_for(db.engine, 'checkout')
+    def checkout(*args):
+        connections['open'] += 1
+        connections['peak'] = max(connections['peak'], connections['open'])
+
+    @event.listens_for(db.engine, 'checkin')
+    def checkin(*args):
+        connections['open'] -= 1
+
+    samples = {'greenlets': 0}
+    running = [True]
+
+    def sample():
+        while running[0]:
+            samples['greenlets'] = max(samples['greenlets'], sum(
+                isinstance(obj, greenlet) for obj in gc.get_objects()))
+            eventlet.sleep(SAMPLE_INTERVAL)
+
+    book_latencies = []
+
+    def book(i):
+        client = app.test_client()
+        client.post('/login', data={
+            'email': f'user{i}@example.com', 'password': 'loadtest'})
+        started = time.monotonic()
+        r = client.post('/book', data={'address': f'{i} Market St'})
+        book_latencies.append(time.monotonic() - started)
+        return r.status_code
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    job_worker.start()
+    notification_sender.start()
+    sampler = eventlet.spawn(sample)
+
+    started = time.monotonic()
+    pool = eventlet.GreenPool(args.concurrency)
+    statuses = list(pool.imap(book, range(args.users)))
+    submitted = time.monotonic() - started
+
+    def finished(booking):
+        return (
+            booking.status in TERMINAL_STATUSES or
+            booking.notified_at is not None)
+
+    with app.app_context():
+        while time.monotonic() - started < args.timeout:
+            bookings = db.session.query(Bookings).all()
+            done = sum(finished(booking) for booking in bookings)
+            db.session.remove()
+            if done >= len(bookings):
+                break
+            eventlet.sleep(SAMPLE_INTERVAL)
+        elapsed = time.monotonic() - started
+        bookings = db.session.query(Bookings).all()
+        db.session.remove()
+    running[0] = False
+    sampler.wait()
+
+    match_latencies = [
+        (booking.matched_at - booking.created_at).total_seconds()
+        for booking in bookings if booking.matched_at is not None]
+    outcomes = {}
+    for booking in bookings:
+        outcomes[booking.status] = outcomes.get(booking.status, 0) + 1
+    done = sum(finished(booking) for booking in bookings)
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    print(f'{args.users} users, {args.concurrency} at once, '
+          f'{args.database_url.split(":")[0]}')
+    print(f'/book responses:    {sorted(set(statuses))}')
+    print(f'/book p50/p99:      {percentile(book_latencies, .5) * 1e3:.0f}'
+          f' / {percentile(book_latencies, .99) * 1e3:.0f} ms')
+    print(f'submitted in:       {submitted:.1f}s')
+    print(f'finished:           {done}/{len(bookings)} in {elapsed:.1f}s '
+          f'({done / elapsed:.1f} bookings/s)')
+    print(f'outcomes:           {outcomes}')
+    print(f'match p50/p99:      {percentile(match_latencies, .5):.2f}'
+          f' / {percentile(match_latencies, .99):.2f} s')
+    print(f'peak greenlets:     {samples["greenlets"]}')
+    print(f'max RSS:            {rss_before // 1024} -> '
+          f'{rss_after // 1024} MB')
+    print(f'DB connections:     peak {connections["peak"]} checked out')
+    print(f'stand-ins:          {standins.stats()}')
+    return 0 if done == len(bookings) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,266 @@
+"""
+Local stand-ins for Social Bicycles, the Google geocoder and SendGrid.
+
+Replay recorded fixtures with added latency and injected failures:
+
+    python -m loadtest.standins [--port 8900] [--latency socialbicycles=0.2]
+        [--failure sendgrid=0.1] [--spread]
+
+Record fixtures by proxying to the real services:
+
+    python -m loadtest.standins --record
+
+Then point the booker at it:
+
+    SOCIAL_BICYCLES_URL=http://127.0.0.1:8900/socialbicycles/api
+    GOOGLE_GEOCODE_URL=http://127.0.0.1:8900/google/maps/api/geocode/json
+    SENDGRID_HOST=http://127.0.0.1:8900/sendgrid
+"""
+import argparse
+import hashlib
+from http import HTTPStatus
+import itertools
+import json
+import os
+import random
+import re
+from collections import defaultdict
+import eventlet
+from eventlet import wsgi
+import requests
+
+FIXTURES_DIR = os.path.join(os.path.dirname(__file__), 'fixtures')
+UPSTREAMS = {
+    'socialbicycles': 'https://app.socialbicycles.com',
+    'google': 'https://maps.googleapis.com',
+    'sendgrid': 'https://api.sendgrid.com',
+}
+# Only the response content type and Retry-After headers are recorded, and
+# these query parameters are left out.
+SECRET_PARAMS = {'key', 'signature', 'client'}
+# Farthest a spread geocode lands from the recorded location, in degrees.
+SPREAD = 0.02
+
+
+def env_for(port, host='127.0.0.1'):
+    """ Environment variables pointing the booker at the stand-ins. """
+
+    base = f'http://{host}:{port}'
+    return {
+        'SOCIAL_BICYCLES_URL': f'{base}/socialbicycles/api',
+        'GOOGLE_GEOCODE_URL': f'{base}/google/maps/api/geocode/json',
+        'SENDGRID_HOST': f'{base}/sendgrid',
+    }
+
+
+def fixture_key(method, path):
+    """ Requests differing only by ids share their recorded responses. """
+
+    return f'{method} {re.sub(r"/[0-9]+(?=/|$|[.])", "/*", path)}'
+
+
+def offset(seed, scale):
+    digest = hashlib.md5(seed.encode()).digest()
+    return (
+        (digest[0] / 255 - 0.5) * 2 * scale,
+        (digest[1] / 255 - 0.5) * 2 * scale)
+
+
+class StandIns:
+    """
+    WSGI app answering for the three services, by path prefix. Responses
+    are replayed round-robin per fixture key, after latency[service] seconds,
+    failing with a 503 at failure[service] rate.
+
+    With spread, geocodes are moved off the recorded location by an offset
+    derived from the query, and bikes.json pages are moved to the requested
+    point with ids of their own, so that many bookings do not all fight for
+    the handful of recorded bikes.
+    """
+
+    def __init__(self, fixtures_dir=FIXTURES_DIR, latency=None,
+                 failure=None, record=False, spread=False):
+        self.fixtures_dir = fixtures_dir
+        self.latency = latency or {}
+        self.failure = failure or {}
+        self.record = record
+        self.spread = spread
+        self.fixtures = {
+            service: self.load(service) for service in UPSTREAMS
+        }
+        self.cursors = defaultdict(itertools.count)
+        self.requests = defaultdict(int)
+        self.failures = defaultdict(int)
+
+    def path(self, service):
+        return os.path.join(self.fixtures_dir, f'{service}.json')
+
+    def load(self, service):
+        try:
+            with open(self.path(service)) as fixtures:
+                return json.load(fixtures)
+        except FileNotFoundError:
+            return {}
+
+    def save(self, service):
+        os.makedirs(self.fixtures_dir, exist_ok=True)
+        with open(self.path(service), 'w') as fixtures:
+            json.dump(self.fixtures[service], fixtures, indent=2,
+                      sort_keys=True)
+            fixtures.write('\n')
+
+    def __call__(self, environ, start_response):
+        service, _, path = environ['PATH_INFO'].lstrip('/').partition('/')
+        path = f'/{path}'
+        method = environ['REQUEST_METHOD']
+        if service not in UPSTREAMS:
+            start_response('404 Not Found', [])
+            return [b'Unknown service']
+        self.requests[service] += 1
+
+        if self.record:
+            status, headers, body = self.proxy(service, method, path, environ)
+        else:
+            eventlet.sleep(self.latency.get(service, 0))
+            if random.random() < self.failure.get(service, 0):
+                self.failures[service] += 1
+                status, headers, body = (
+                    503, {'Content-Type': 'application/json'},
+                    '{"error": "injected failure"}')
+            else:
+                status, headers, body = self.replay(
+                    service, method, path, environ)
+
+        start_response(
+            f'{status} {HTTPStatus(status).phrase}',
+            list(headers.items()))
+        return [body.encode()]
+
+    def replay(self, service, method, path, environ):
+        responses = self.fixtures[service].get(fixture_key(method, path))
+        if not responses:
+            return 404, {}, f'No fixture for {method} {path}'
+        response = responses[
+            next(self.cursors[fixture_key(method, path)]) % len(responses)]
+        body = response['body']
+        if self.spread:
+            body = self.spread_body(service, path, environ, body)
+        return response['status'], response['headers'], body
+
+    def spread_body(self, service, path, environ, body):
+        params = dict(
+            pair.split('=', 1) for pair in
+            environ.get('QUERY_STRING', '').split('&') if '=' in pair)
+        if service == 'google' and params.get('address'):
+            payload = json.loads(body)
+            d_lat, d_lng = offset(params['address'], SPREAD)
+            for result in payload.get('results', []):
+                location = result['geometry']['location']
+                location['lat'] += d_lat
+                location['lng'] += d_lng
+            return json.dumps(payload)
+
+        if path.endswith('/bikes.json') and 'latitude' in params:
+            payload = json.loads(body)
+            latitude = float(params['latitude'])
+            longitude = float(params['longitude'])
+            positions = [
+                item['current_position']['coordinates']
+                for item in payload['items']]
+            if not positions:
+                return body
+            center_lng = sum(p[0] for p in positions) / len(positions)
+            center_lat = sum(p[1] for p in positions) / len(positions)
+            # Same point, same bikes; another point, other bikes.
+            id_base = int(hashlib.md5(
+                f'{latitude:.4f},{longitude:.4f}'.encode()
+            ).hexdigest()[:6], 16) * 1000
+            for item, position in zip(payload['items'], positions):
+                item['id'] = id_base + item['id'] % 1000
+                position[0] += longitude - center_lng
+                position[1] += latitude - center_lat
+            return json.dumps(payload)
+        return body
+
+    def proxy(self, service, method, path, environ):
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        headers = {
+            name[5:].replace('_', '-').title(): value
+            for name, value in environ.items()
+            if name.startswith('HTTP_') and name != 'HTTP_HOST'
+        }
+        if environ.get('CONTENT_TYPE'):
+            headers['Content-Type'] = environ['CONTENT_TYPE']
+        r = requests.request(
+            method, f'{UPSTREAMS[service]}{path}',
+            params=environ.get('QUERY_STRING'), headers=headers,
+            data=environ['wsgi.input'].read(length) if length else None,
+            timeout=30)
+        response_headers = {
+            'Content-Type': r.headers.get('Content-Type', 'text/plain')}
+        if 'Retry-After' in r.headers:
+            response_headers['Retry-After'] = r.headers['Retry-After']
+        self.fixtures[service].setdefault(
+            fixture_key(method, path), []).append({
+                'status': r.status_code,
+                'headers': response_headers,
+                'query': '&'.join(
+                    pair for pair in environ.get('QUERY_STRING', '').split('&')
+                    if pair.split('=', 1)[0] not in SECRET_PARAMS),
+                'body': r.text,
+            })
+        self.save(service)
+        return r.status_code, response_headers, r.text
+
+    def stats(self):
+        return {
+            service: {
+                'requests': self.requests[service],
+                'injected_failures': self.failures[service],
+            }
+            for service in UPSTREAMS
+        }
+
+
+def serve(app, port=0, host='127.0.0.1'):
+    """ Serve the stand-ins from a greenlet, return the bound port. """
+
+    listener = eventlet.listen((host, port))
+    eventlet.spawn(wsgi.server, listener, app, log_output=False)
+    return listener.getsockname()[1]
+
+
+def service_rates(pairs):
+    """ Parse service=value flags into a dict. """
+
+    rates = {}
+    for pair in pairs or []:
+        service, _, value = pair.partition('=')
+        if service not in UPSTREAMS:
+            raise argparse.ArgumentTypeError(f'Unknown service {service}')
+        rates[service] = float(value)
+    return rates
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--port', type=int, default=8900)
+    parser.add_argument('--fixtures', default=FIXTURES_DIR)
+    parser.add_argument('--record', action='store_true')
+    parser.add_argument('--spread', action='store_true')
+    parser.add_argument('--latency', action='append', metavar='SERVICE=S')
+    parser.add_argument('--failure', action='append', metavar='SERVICE=P')
+    args = parser.parse_args()
+
+    eventlet.monkey_patch()
+    app = StandIns(
+        args.fixtures, service_rates(args.latency),
+        service_rates(args.failure), args.record, args.spread)
+    for name, value in env_for(args.port).items():
+        print(f'{name}={value}')
+    wsgi.server(
+        eventlet.listen(('127.0.0.1', args.port)), app, log_output=False)
+
+
+if __name__ == '__main__':
+    main()
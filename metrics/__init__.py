@@ -0,0 +1,217 @@
+""" Process-wide metrics, rendered in the Prometheus text format. """
+from bisect import bisect_left
+import time
+
+# Upper bounds in seconds of the latency histogram buckets.
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return (
+        str(value)
+        .replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(
+        f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class GaugeValue(CounterValue):
+    __slots__ = ()
+
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class HistogramValue:
+    __slots__ = ('buckets', 'counts', 'total', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def time(self):
+        """ Context manager observing the seconds spent in its block. """
+
+        return _Timer(self)
+
+    def summary(self):
+        labels = [f'<={bound}s' for bound in self.buckets] + ['+Inf']
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0,
+            'buckets': dict(zip(labels, self.counts)),
+        }
+
+
+class _Timer:
+    __slots__ = ('histogram', 'started')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.started = time.monotonic()
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.monotonic() - self.started)
+
+
+class Metric:
+    """
+    A named metric with one value per combination of label values.
+    Updates are plain arithmetic, greenlets only switch on I/O so they need
+    no lock.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def new_value(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        key = tuple(str(value) for value in values)
+        value = self.values.get(key)
+        if value is None:
+            value = self.values[key] = self.new_value()
+        return value
+
+    def children(self):
+        return sorted(self.values.items())
+
+    def samples(self):
+        """ (suffix, labels, value) of every line of the metric. """
+
+        for key, value in self.children():
+            yield '', _labels(self.labelnames, key), value.value
+
+    def render(self):
+        lines = [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.kind}',
+        ]
+        lines.extend(
+            f'{self.name}{suffix}{labels} {value}'
+            for suffix, labels, value in self.samples())
+        return '\n'.join(lines) + '\n'
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def new_value(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    """ A gauge set by the code, or read from function when rendered. """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def new_value(self):
+        return GaugeValue()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def samples(self):
+        if self.function is not None:
+            yield '', '', self.function()
+        else:
+            yield from super().samples()
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(),
+                 buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def new_value(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def samples(self):
+        for key, value in self.children():
+            cumulative = 0
+            for bound, count in zip(
+                    self.buckets + ('+Inf',), value.counts):
+                cumulative += count
+                yield '_bucket', _labels(
+                    self.labelnames, key, [('le', bound)]), cumulative
+            labels = _labels(self.labelnames, key)
+            yield '_sum', labels, value.total
+            yield '_count', labels, value.count
+
+
+class Registry:
+    """ Metrics by name, registering a name twice returns the same metric. """
+
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, cls, name, *args, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, *args, **kwargs)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self._register(
+            Gauge, name, documentation, labelnames, function=function)
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=LATENCY_BUCKETS):
+        return self._register(
+            Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def render(self):
+        return ''.join(
+            metric.render() for _, metric in sorted(self.metrics.items()))
+
+
+registry = Registry()
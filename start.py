@@ -1,4 +1,12 @@
-from booker import app, socket
+from booker import create_app, socket
+from booker.book_bike import job_worker
+from booker.notifications import notification_sender
+
+app = create_app()
+
+# Every web worker also pulls trip-search jobs and drains the email outbox.
+job_worker.start()
+notification_sender.start()
 
 if __name__ == '__main__':
     socket.run(app, port='4999')
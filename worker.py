@@ -0,0 +1,16 @@
+import sys
+from booker import create_app
+from booker.book_bike import job_worker
+from booker.notifications import notification_sender
+from custom_logger import logger
+
+if __name__ == '__main__':
+    # Standalone worker, scale the search throughput by adding more of them.
+    app = create_app()
+    # Its pushes reach the pages connected to the web processes through the
+    # message queue only, without one they would all be lost.
+    if not app.config['SOCKETIO_MESSAGE_QUEUE']:
+        logger.error('The worker needs REDIS_URL to push to the web clients')
+        sys.exit(1)
+    notification_sender.start()
+    job_worker.start().join()